@@ -75,6 +75,11 @@ VERSIONS = getattr(settings, "FILEBROWSER_VERSIONS", {
 ADMIN_VERSIONS = getattr(settings, 'FILEBROWSER_ADMIN_VERSIONS', ['thumbnail', 'small', 'medium', 'big'])
 # Which Version should be used as Admin-thumbnail.
 ADMIN_THUMBNAIL = getattr(settings, 'FILEBROWSER_ADMIN_THUMBNAIL', 'fb_thumb')
+# Number of processes generating versions in the background.
+# Set to 0 in order to generate versions while rendering templates.
+VERSION_PROCESSES = getattr(settings, 'FILEBROWSER_VERSION_PROCESSES', 2)
+# Shown instead of versions which are still being generated.
+VERSION_PLACEHOLDER = getattr(settings, 'FILEBROWSER_VERSION_PLACEHOLDER', URL_FILEBROWSER_MEDIA + 'img/filebrowser_type_image.gif')
 
 # EXTRA SETTINGS
 # True to save the URL including MEDIA_URL to your model fields
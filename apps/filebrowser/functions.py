@@ -251,10 +251,18 @@ def _version_generator(value, version_prefix, force=None):
             os.makedirs(version_dir)
             os.chmod(version_dir, 0775)
         version = scale_and_crop(im, VERSIONS[version_prefix]['width'], VERSIONS[version_prefix]['height'], VERSIONS[version_prefix]['opts'])
+        # save under a temporary name (with the same extension, which tells
+        # the format), so the version never appears half-written
+        temporary_path = os.path.join(version_dir, u".tmp-%d-%s" % (os.getpid(), os.path.split(absolute_version_path)[1]))
         try:
-            version.save(absolute_version_path, quality=90, optimize=1)
-        except IOError:
-            version.save(absolute_version_path, quality=90)
+            try:
+                version.save(temporary_path, quality=90, optimize=1)
+            except IOError:
+                version.save(temporary_path, quality=90)
+            os.rename(temporary_path, absolute_version_path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.unlink(temporary_path)
         return version_path
     except:
         return None
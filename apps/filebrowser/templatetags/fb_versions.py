@@ -1,14 +1,14 @@
 # coding: utf-8
 
-import os
 import re
 from django.template import Library, Node, Variable, VariableDoesNotExist, TemplateSyntaxError
 from django.conf import settings
 from django.utils.encoding import force_unicode
 
 # filebrowser imports
-from filebrowser.fb_settings import MEDIA_ROOT, MEDIA_URL, VERSIONS
-from filebrowser.functions import _url_to_path, _path_to_url, _get_version_path, _version_generator
+from filebrowser.fb_settings import VERSIONS
+from filebrowser.functions import _url_to_path
+from filebrowser.versioning import version_path, version_url, queue_version
 from filebrowser.base import FileObject
 
 import logging
@@ -41,14 +41,8 @@ class VersionNode(Node):
                 return None
 
         try:
-            version_path = _get_version_path(_url_to_path(str(source)), version_prefix)
-            if not os.path.isfile(os.path.join(MEDIA_ROOT, version_path)):
-                # create version
-                version_path = _version_generator(_url_to_path(str(source)), version_prefix)
-            elif os.path.getmtime(os.path.join(MEDIA_ROOT, _url_to_path(str(source)))) > os.path.getmtime(os.path.join(MEDIA_ROOT, version_path)):
-                # recreate version if original image was updated
-                version_path = _version_generator(_url_to_path(str(source)), version_prefix, force=True)
-            return _path_to_url(version_path)
+            # versions are generated in the background, see filebrowser.versioning
+            return version_url(_url_to_path(force_unicode(source)), version_prefix)
         except Exception:
             logger.exception("Version error")
             return u""
@@ -98,14 +92,13 @@ class VersionObjectNode(Node):
             except VariableDoesNotExist:
                 return None
         try:
-            version_path = _get_version_path(_url_to_path(str(source)), version_prefix)
-            if not os.path.isfile(os.path.join(MEDIA_ROOT, version_path)):
-                # create version
-                version_path = _version_generator(_url_to_path(str(source)), version_prefix)
-            elif os.path.getmtime(os.path.join(MEDIA_ROOT, _url_to_path(str(source)))) > os.path.getmtime(os.path.join(MEDIA_ROOT, version_path)):
-                # recreate version if original image was updated
-                version_path = _version_generator(_url_to_path(str(source)), version_prefix, force=True)
-            context[self.var_name] = FileObject(version_path)
+            path = _url_to_path(force_unicode(source))
+            version = version_path(path, version_prefix)
+            if version is None:
+                queue_version(path, version_prefix)
+                context[self.var_name] = ""
+            else:
+                context[self.var_name] = FileObject(version)
         except:
             context[self.var_name] = ""
         return ''
@@ -0,0 +1,164 @@
+# coding: utf-8
+
+"""
+Image versions, generated in the background.
+
+Versions are generated in a pool of VERSION_PROCESSES processes when
+images are uploaded, or when a template asks for a version which isn't
+there yet; until it's generated, templates show VERSION_PLACEHOLDER.
+A version requested again while it's waiting is queued only once, and
+one which couldn't be generated isn't queued again until its image changes.
+"""
+
+import os
+import threading
+import multiprocessing
+
+# filebrowser imports
+from filebrowser.fb_settings import *
+from filebrowser.functions import _version_generator, _path_to_url
+
+import logging
+logger = logging.getLogger("django.filebrowser")
+
+
+def _version_filename(path, version_prefix):
+    filename, ext = os.path.splitext(os.path.basename(path))
+    return filename + u"_" + version_prefix + ext
+
+
+def _versions_dir(path):
+    return os.path.join(MEDIA_ROOT, VERSIONS_BASEDIR, os.path.dirname(path))
+
+
+# directory -> (mtime, names of files in it)
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+def version_manifest(directory):
+    """
+    Names of versions in a directory of versions. Directories are
+    listed again only when their modification time changes.
+    """
+    try:
+        mtime = os.stat(directory).st_mtime
+    except OSError:
+        return frozenset()
+
+    _manifests_lock.acquire()
+    try:
+        cached = _manifests.get(directory)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    finally:
+        _manifests_lock.release()
+
+    names = frozenset(os.listdir(directory))
+    _manifests_lock.acquire()
+    try:
+        _manifests[directory] = (mtime, names)
+    finally:
+        _manifests_lock.release()
+    return names
+
+
+def version_path(path, version_prefix):
+    """
+    Path of a version of an image, relative to MEDIA_ROOT, if it has been
+    generated, or None. `path` is relative to MEDIA_ROOT.
+    """
+    filename = _version_filename(path, version_prefix)
+    if filename not in version_manifest(_versions_dir(path)):
+        return None
+    return os.path.join(VERSIONS_BASEDIR, os.path.dirname(path), filename)
+
+
+def generate_version(path, version_prefix, force=False):
+    """
+    Generate a version of an image, unless it's there already.
+    Returns False if it couldn't be generated.
+    """
+    try:
+        if not force and os.path.isfile(os.path.join(_versions_dir(path), _version_filename(path, version_prefix))):
+            return True
+        if _version_generator(path, version_prefix, force=force) is None:
+            logger.error("Unable to generate version %r of %r", version_prefix, path)
+            return False
+        return True
+    except Exception:
+        logger.exception("Version error")
+        return False
+
+
+def _source_mtime(path):
+    try:
+        return os.path.getmtime(os.path.join(MEDIA_ROOT, path))
+    except OSError:
+        return None
+
+
+_pending = set()
+# (path, version_prefix) -> modification time of the image when
+# generating the version failed
+_failed = {}
+_pending_lock = threading.Lock()
+_pool = None
+
+def _done(key, mtime, ok):
+    _pending_lock.acquire()
+    try:
+        _pending.discard(key)
+        if ok:
+            _failed.pop(key, None)
+        else:
+            _failed[key] = mtime
+    finally:
+        _pending_lock.release()
+
+
+def queue_version(path, version_prefix, force=False):
+    """
+    Generate a version of an image in the background, unless it's already
+    waiting to be generated. With VERSION_PROCESSES set to 0, the version
+    is generated right away. Versions which couldn't be generated from
+    the image as it is now are skipped, unless `force` is set.
+    """
+    global _pool
+    key = (path, version_prefix)
+    mtime = _source_mtime(path)
+
+    _pending_lock.acquire()
+    try:
+        if key in _pending or (not force and key in _failed and _failed[key] == mtime):
+            return
+        _pending.add(key)
+        if VERSION_PROCESSES and _pool is None:
+            _pool = multiprocessing.Pool(VERSION_PROCESSES)
+    finally:
+        _pending_lock.release()
+
+    if not VERSION_PROCESSES:
+        _done(key, mtime, generate_version(path, version_prefix, force))
+        return
+    _pool.apply_async(generate_version, (path, version_prefix, force),
+                      callback=lambda ok: _done(key, mtime, ok))
+
+
+def version_url(path, version_prefix):
+    """
+    URL of a version of an image, given its path relative to MEDIA_ROOT.
+    If the version isn't there yet, it's queued and VERSION_PLACEHOLDER
+    is returned instead.
+    """
+    generated = version_path(path, version_prefix)
+    if generated is None:
+        queue_version(path, version_prefix)
+        return VERSION_PLACEHOLDER
+    return _path_to_url(generated)
+
+
+def generate_uploaded_versions(sender, path, file, **kwargs):
+    """Queue ADMIN_VERSIONS and ADMIN_THUMBNAIL of uploaded images."""
+    if file.filetype == 'Image':
+        for version_prefix in set(list(ADMIN_VERSIONS) + [ADMIN_THUMBNAIL]):
+            queue_version(file.path, version_prefix, force=True)
@@ -29,6 +29,7 @@ from filebrowser.functions import (
 from filebrowser.templatetags.fb_tags import query_helper
 from filebrowser.base import FileObject
 from filebrowser.decorators import flash_login_required
+from filebrowser.versioning import generate_uploaded_versions
 
 # Precompile regular expressions
 filter_re = []
@@ -242,6 +243,7 @@ def _check_file(request):
 # upload signals
 filebrowser_pre_upload = Signal(providing_args=["path", "file"])
 filebrowser_post_upload = Signal(providing_args=["path", "file"])
+filebrowser_post_upload.connect(generate_uploaded_versions)
 
 
 def _upload_file(request):
@@ -3,3 +3,9 @@ from django.contrib import admin
 from wiki import models
 
 admin.site.register(models.Theme)
+
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ('file_path', 'status', 'worker', 'created_at', 'processed', 'total')
+    list_filter = ('status',)
+
+admin.site.register(models.ImportJob, ImportJobAdmin)
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of FNP-Redakcja, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+"""
+    Caches for data derived from document revisions.
+
+    Stored revisions never change, so anything computed from them can be
+    cached without worrying about invalidation. Each named cache keeps
+    its entries in process memory, within a size budget, and can use
+    a Django cache backend as a second, shared tier. See WIKI_CACHES in
+    wiki.settings.
+"""
+import threading
+from hashlib import sha1
+
+from django.core.cache import get_cache as get_backend
+
+from wiki import settings
+
+import logging
+logger = logging.getLogger("fnp.wiki.cache")
+
+DEFAULT_SIZE = 16 * 1024 * 1024
+
+
+def estimate_size(value):
+    """
+    Roughly estimate how much memory a value takes, in bytes.
+
+    >>> estimate_size(u'abc')
+    6
+    >>> estimate_size({'a': [1, 2]})
+    33
+    """
+    if isinstance(value, unicode):
+        return 2 * len(value)
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(estimate_size(k) + estimate_size(v) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_size(v) for v in value)
+    return 16
+
+
+class LRUCache(object):
+    """
+    Thread-safe in-memory cache which evicts least recently used entries
+    when the total size of its values exceeds given budget (in bytes).
+
+    >>> cache = LRUCache(10)
+    >>> cache.set('a', 'xxxx'); cache.set('b', 'yyyy')
+    >>> cache.get('a')
+    'xxxx'
+    >>> cache.set('c', 'zzzz')
+    >>> cache.get('b') is None
+    True
+    >>> sorted(cache.keys())
+    ['a', 'c']
+    """
+
+    PREV, NEXT, KEY, VALUE, SIZE = range(5)
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        # circular doubly-linked list, most recently used first
+        self._root = root = []
+        root[:] = [root, root, None, None, 0]
+
+    def keys(self):
+        return self._entries.keys()
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            self._unlink(entry)
+            self._link(entry)
+            return entry[self.VALUE]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, size=None):
+        if size is None:
+            size = estimate_size(value)
+        if size > self.max_size:
+            return
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._unlink(entry)
+                self.size -= entry[self.SIZE]
+
+            while self.size + size > self.max_size:
+                oldest = self._root[self.PREV]
+                self._unlink(oldest)
+                del self._entries[oldest[self.KEY]]
+                self.size -= oldest[self.SIZE]
+
+            entry = self._entries[key] = [None, None, key, value, size]
+            self._link(entry)
+            self.size += size
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._unlink(entry)
+                self.size -= entry[self.SIZE]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._root[:] = [self._root, self._root, None, None, 0]
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def _link(self, entry):
+        root = self._root
+        first = root[self.NEXT]
+        entry[self.PREV], entry[self.NEXT] = root, first
+        first[self.PREV] = root[self.NEXT] = entry
+
+    def _unlink(self, entry):
+        prev, next = entry[self.PREV], entry[self.NEXT]
+        prev[self.NEXT], next[self.PREV] = next, prev
+
+
+class DerivedDataCache(object):
+    """
+    Two-tier cache: an in-memory LRU cache backed by an optional
+    Django cache backend.
+    """
+
+    def __init__(self, name, max_size=DEFAULT_SIZE, backend=None):
+        self.name = name
+        self.memory = max_size and LRUCache(max_size) or None
+        self.backend = backend and get_backend(backend) or None
+
+    def backend_key(self, key):
+        return 'wiki:%s:%s' % (self.name, sha1(repr(key)).hexdigest())
+
+    def get(self, key, default=None):
+        if self.memory is not None:
+            value = self.memory.get(key)
+            if value is not None:
+                return value
+
+        if self.backend is not None:
+            value = self.backend.get(self.backend_key(key))
+            if value is not None:
+                if self.memory is not None:
+                    self.memory.set(key, value)
+                return value
+
+        return default
+
+    def set(self, key, value):
+        if self.memory is not None:
+            self.memory.set(key, value)
+        if self.backend is not None:
+            self.backend.set(self.backend_key(key), value)
+
+    def delete(self, key):
+        if self.memory is not None:
+            self.memory.delete(key)
+        if self.backend is not None:
+            self.backend.delete(self.backend_key(key))
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_cache(name, max_size=DEFAULT_SIZE):
+    """
+    Return the process-wide cache with given name, configured according
+    to WIKI_CACHES; `max_size` is the memory budget used by default.
+    """
+    _caches_lock.acquire()
+    try:
+        try:
+            return _caches[name]
+        except KeyError:
+            config = settings.CACHES.get(name, {})
+            cache = _caches[name] = DerivedDataCache(name,
+                    max_size=config.get('SIZE', max_size),
+                    backend=config.get('BACKEND'))
+            logger.debug("Created cache %r: %r", name, config)
+            return cache
+    finally:
+        _caches_lock.release()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of FNP-Redakcja, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+"""
+    Catalogue of documents, kept in the database.
+
+    Listing documents from the repository means reading its whole manifest,
+    so the catalogue is kept as CatalogueEntries instead, refreshed with
+    changes committed since the last refresh. The revision it's refreshed
+    to and its node are kept as CatalogueState: if the node doesn't match
+    the repository any more, its history was rewritten and the catalogue
+    is rebuilt.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+
+from wiki.models import CatalogueEntry, CatalogueState, STAGE_TAGS_RE, split_name, join_name
+from wiki.templatetags.wiki import wiki_title
+
+import logging
+logger = logging.getLogger("fnp.wiki.catalogue")
+
+# the only CatalogueState
+STATE_ID = 1
+
+
+def refresh(storage):
+    """Update the catalogue with changes committed since the last refresh."""
+    vstorage = storage.vstorage
+    # see commits of other processes, which may have refreshed it
+    vstorage.refresh()
+    tip = vstorage.repo_revision()
+
+    try:
+        state = CatalogueState.objects.get(pk=STATE_ID)
+    except CatalogueState.DoesNotExist:
+        state = CatalogueState(pk=STATE_ID, revision=-1, node=vstorage.revision_node(-1))
+    last = state.revision
+    if vstorage.revision_node(last) != state.node:
+        logger.warning("Catalogue doesn't match the repository, rebuilding it")
+        CatalogueEntry.objects.all().delete()
+        last = -1
+    elif last >= tip:
+        return
+
+    # newest change and stage of every changed document
+    changesets = {}
+    stages = {}
+    for changeset in vstorage.history(cursor=tip + 1):
+        if changeset['revision'] <= last:
+            break
+        stage = STAGE_TAGS_RE.findall(changeset['description'])
+        for name in changeset['pages']:
+            changesets.setdefault(name, changeset['revision'])
+            if stage and name not in stages:
+                stages[name] = stage[-1].strip()
+
+    logger.debug("Refreshing %d catalogue entries", len(changesets))
+    for name, revision in changesets.iteritems():
+        values = {
+            'group': split_name(name)[0],
+            'title': wiki_title(name),
+            'changeset': revision,
+            'deleted': name not in vstorage,
+        }
+        if not values['deleted']:
+            meta = vstorage.page_meta(name)
+            values.update(revision=meta['revision'], author=meta['author'],
+                          modified=meta['date'])
+        if name in stages:
+            values['stage'] = stages[name]
+
+        if not CatalogueEntry.objects.filter(name=name).update(**values):
+            try:
+                CatalogueEntry.objects.create(name=name, **values)
+            except IntegrityError:
+                # created by a concurrent refresh
+                transaction.rollback_unless_managed()
+                CatalogueEntry.objects.filter(name=name).update(**values)
+
+    state.revision, state.node = tip, vstorage.revision_node(tip)
+    try:
+        state.save()
+    except IntegrityError:
+        # created by a concurrent refresh
+        transaction.rollback_unless_managed()
+
+
+def entries(parts=(), query=None):
+    """
+    Current documents in the catalogue, optionally only those with
+    given leading name `parts`, or with names containing `query`.
+    """
+    entries = CatalogueEntry.objects.filter(deleted=False)
+    if parts:
+        name = join_name(*parts)
+        entries = entries.filter(Q(name=name) | Q(name__startswith=name + u'__'))
+    if query:
+        # the same as the list's filter script does
+        entries = entries.filter(name__icontains=query)
+    return entries
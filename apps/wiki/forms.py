@@ -56,8 +56,7 @@ class DocumentsUploadForm(forms.Form):
             z = self.cleaned_data['zip'] = zipfile.ZipFile(file)
         except zipfile.BadZipfile:
             raise forms.ValidationError("Should be a ZIP file.")
-        if z.testzip():
-            raise forms.ValidationError("ZIP file corrupt.")
+        # members are checked when the file is imported
 
         return self.cleaned_data
 
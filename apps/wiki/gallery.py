@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of FNP-Redakcja, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+"""
+    Listings of scan galleries.
+
+    Listing a gallery means reading the headers of all its images, so
+    listings are cached, keyed by modification times of the gallery's
+    directory and of its versions' directory. Changing an image
+    in place doesn't change them: replace images with new files.
+"""
+import os
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+from django.conf import settings as django_settings
+from django.utils.encoding import smart_unicode
+
+from filebrowser.fb_settings import VERSIONS
+
+from wiki import settings
+from wiki.cache import get_cache
+from wiki.scans import pyramid_levels
+
+import logging
+logger = logging.getLogger("fnp.wiki.gallery")
+
+IMAGE_EXTENSIONS = (u'.jpg', u'.jpeg', u'.png')
+
+_gallery_cache = get_cache('gallery', 4 * 1024 * 1024)
+
+
+def gallery_location(directory):
+    """Return the filesystem path and URL of a gallery directory."""
+    base_url = ''.join((
+                    smart_unicode(django_settings.MEDIA_URL),
+                    smart_unicode(django_settings.FILEBROWSER_DIRECTORY),
+                    smart_unicode(directory)))
+
+    base_dir = os.path.join(
+                smart_unicode(django_settings.MEDIA_ROOT),
+                smart_unicode(django_settings.FILEBROWSER_DIRECTORY),
+                smart_unicode(directory))
+
+    return base_dir, base_url
+
+
+def versions_location(directory):
+    """
+    Return the filesystem path and URL of the directory of a gallery's
+    image versions (made by filebrowser) and tiles (see wiki.scans).
+    """
+    path = os.path.join(
+                smart_unicode(getattr(django_settings, 'FILEBROWSER_VERSIONS_BASEDIR', '')),
+                smart_unicode(django_settings.FILEBROWSER_DIRECTORY),
+                smart_unicode(directory))
+    return (os.path.join(smart_unicode(django_settings.MEDIA_ROOT), path),
+            smart_unicode(django_settings.MEDIA_URL) + path)
+
+
+def version_name(filename, version):
+    """
+    Name of an image's version, the way filebrowser names them.
+
+    >>> version_name(u'001.jpg', 'thumbnail')
+    u'001_thumbnail.jpg'
+    """
+    name, ext = os.path.splitext(filename)
+    return u"%s_%s%s" % (name, version, ext)
+
+
+def version_size(size, version):
+    """
+    Dimensions of a version of an image of given `size`, the same
+    as made by filebrowser.functions.scale_and_crop.
+
+    >>> version_size((1000, 1500), {'width': 620, 'height': '', 'opts': ''})
+    (620, 930)
+    >>> version_size((100, 150), {'width': 620, 'height': '', 'opts': ''})
+    (100, 150)
+    """
+    x, y = [float(v) for v in size]
+    xr = float(version['width'] or x * version['height'] / y)
+    yr = float(version['height'] or y * version['width'] / x)
+    if 'crop' in version['opts']:
+        r = max(xr / x, yr / y)
+    else:
+        r = min(xr / x, yr / y)
+    if r < 1.0 or (r > 1.0 and 'upscale' in version['opts']):
+        x, y = int(x * r), int(y * r)
+    if 'crop' in version['opts']:
+        x, y = min(x, xr), min(y, yr)
+    return int(x), int(y)
+
+
+def is_image(filename):
+    return os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS
+
+
+def image_size(path):
+    """Read dimensions of an image from its header, or (None, None)."""
+    try:
+        return Image.open(path).size
+    except IOError:
+        logger.warning("Unable to read image %r", path)
+        return None, None
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def gallery_stamp(directory):
+    """
+    Modification times of a gallery's directory and its versions'
+    directory. Raises OSError if the gallery doesn't exist.
+    """
+    return (os.stat(gallery_location(directory)[0]).st_mtime,
+            _mtime(versions_location(directory)[0]))
+
+
+def list_images(directory):
+    """
+    Images of a gallery, sorted by name, as dicts with `url`, `width`,
+    `height`, `thumbnail` - the URL of the thumbnail, if there is one,
+    `versions` - available smaller versions, as dicts with `version`,
+    `url`, `width` and `height`, from the smallest - and `tiles`
+    - the URL of Deep Zoom descriptor, the tile size and the number
+    of levels of the image's tile pyramid, if it's ready.
+    Raises OSError if the gallery doesn't exist.
+    """
+    base_dir, base_url = gallery_location(directory)
+    versions_dir, versions_url = versions_location(directory)
+
+    key = (base_dir, gallery_stamp(directory))
+    images = _gallery_cache.get(key)
+    if images is not None:
+        return images
+
+    try:
+        renditions = set(map(smart_unicode, os.listdir(versions_dir)))
+    except OSError:
+        renditions = set()
+
+    images = []
+    for filename in sorted(f for f in map(smart_unicode, os.listdir(base_dir)) if is_image(f)):
+        width, height = image_size(os.path.join(base_dir, filename))
+
+        versions = []
+        for version in settings.GALLERY_VERSIONS:
+            name = version_name(filename, version)
+            if name in renditions and width is not None:
+                version_width, version_height = version_size((width, height), VERSIONS[version])
+                versions.append({
+                    "version": version,
+                    "url": u"%s/%s" % (versions_url, name),
+                    "width": version_width,
+                    "height": version_height,
+                })
+        versions.sort(key=lambda version: version["width"])
+
+        thumbnail = version_name(filename, settings.GALLERY_THUMBNAIL_VERSION)
+        descriptor = os.path.splitext(filename)[0] + u'.dzi'
+        images.append({
+            "url": u"%s/%s" % (base_url, filename),
+            "width": width,
+            "height": height,
+            "thumbnail": thumbnail in renditions and u"%s/%s" % (versions_url, thumbnail) or None,
+            "versions": versions,
+            "tiles": descriptor in renditions and width is not None and {
+                "url": u"%s/%s" % (versions_url, descriptor),
+                "tile_size": settings.GALLERY_TILE_SIZE,
+                "levels": pyramid_levels(width, height),
+            } or None,
+        })
+
+    _gallery_cache.set(key, images)
+    return images
@@ -1,22 +1,76 @@
+import re
+import zlib
+import unicodedata
 from django import http
 from django.utils import simplejson as json
 from django.utils.functional import Promise
+from django.utils.cache import patch_vary_headers
 from datetime import datetime
 from functools import wraps
 
+from wiki import settings
+
+
+def format_datetime(dt):
+    """
+    Format a datetime the way it's sent to clients. Format dates up front
+    when serializing a lot of them, the encoder's fallback is slower.
+
+    >>> format_datetime(datetime(2010, 5, 1, 12, 30))
+    'Sat May  1 12:30:00 2010 GMT'
+    """
+    return datetime.ctime(dt) + " " + (datetime.tzname(dt) or 'GMT')
+
 
 class ExtendedEncoder(json.JSONEncoder):
+    """
+    JSON encoder which handles dates and lazy translations.
+
+    django.utils.simplejson already picks the fastest implementation
+    available (simplejson or json with C speedups), which calls default()
+    only for objects it can't handle by itself.
+    """
 
     def default(self, obj):
+        if isinstance(obj, datetime):
+            return format_datetime(obj)
+
         if isinstance(obj, Promise):
             return unicode(obj)
 
-        if isinstance(obj, datetime):
-            return datetime.ctime(obj) + " " + (datetime.tzname(obj) or 'GMT')
-
         return json.JSONEncoder.default(self, obj)
 
 
+class _FoldTable(dict):
+    """Translation table for `fold`, filled in as characters are met."""
+
+    def __missing__(self, char):
+        decomposed = unicodedata.normalize('NFKD', unichr(char).lower())
+        folded = self[char] = ord(decomposed[0])
+        return folded
+
+# no decomposition for these
+_fold_table = _FoldTable({0x141: ord(u'l'), 0x142: ord(u'l')})
+
+def fold(text):
+    """
+    Lowercase text and strip diacritics, leaving it the same length,
+    so positions in folded text are valid in the original.
+
+    >>> fold(u'Za\\u017c\\xf3\\u0142\\u0107 G\\u0118\\u015aL\\u0104')
+    u'zazolc gesla'
+    """
+    return text.translate(_fold_table)
+
+
+# Encoders don't keep state between calls, so one can be shared. Our data
+# is never self-referential, so skip the circular reference checks.
+_encoder = ExtendedEncoder(check_circular=False)
+
+def dumps(data):
+    return _encoder.encode(data)
+
+
 # shortcut for JSON reponses
 class JSONResponse(http.HttpResponse):
 
@@ -24,10 +78,75 @@ class JSONResponse(http.HttpResponse):
         # get rid of mimetype
         kwargs.pop('mimetype', None)
 
-        data = json.dumps(data, cls=ExtendedEncoder)
+        data = dumps(data)
         super(JSONResponse, self).__init__(data, mimetype="application/json", **kwargs)
 
 
+GZIP_RE = re.compile(r'\bgzip\b')
+
+def accepts_gzip(request):
+    return GZIP_RE.search(request.META.get('HTTP_ACCEPT_ENCODING', '')) is not None
+
+
+def gzip_iter(chunks, level=None):
+    """Compress an iterable of strings into gzip format, chunk by chunk."""
+    if level is None:
+        level = settings.GZIP_LEVEL
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def gzip_string(data, level=None):
+    return ''.join(gzip_iter([data], level))
+
+
+class GzippedResponse(http.HttpResponse):
+    """
+    Response with content already compressed with gzip. The content may be
+    an iterator, in which case it's compressed while being sent.
+    """
+
+    def __init__(self, content, **kwargs):
+        super(GzippedResponse, self).__init__(content, **kwargs)
+        self['Content-Encoding'] = 'gzip'
+        patch_vary_headers(self, ('Accept-Encoding',))
+
+
+def json_response(request, data):
+    """
+    Return a JSON response, encoded and gzip-compressed incrementally
+    if the client accepts it, so large payloads are never held in memory
+    as a whole. `data` may also be an iterator of array items. Views
+    using it must set an ETag, or else never_cache would consume the
+    content to compute one.
+    """
+    is_iterator = hasattr(data, 'next')
+    if not accepts_gzip(request):
+        return JSONResponse(is_iterator and list(data) or data)
+
+    if is_iterator:
+        chunks = iterencode_items(data)
+    else:
+        chunks = _encoder.iterencode(data)
+    return GzippedResponse(gzip_iter(chunks), mimetype="application/json")
+
+
+def iterencode_items(items):
+    """Encode items of an iterable as a JSON array, one item at a time."""
+    yield '['
+    for n, item in enumerate(items):
+        if n:
+            yield ', '
+        yield _encoder.encode(item)
+    yield ']'
+
+
 # return errors
 class JSONFormInvalid(JSONResponse):
     def __init__(self, form):
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of FNP-Redakcja, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+"""
+    Bulk import of documents from ZIP files.
+
+    Uploaded files are spooled to IMPORT_SPOOL_PATH and queued as ImportJobs.
+    Jobs are run by the importworker management command: all files are
+    checked first and, only if there are no errors, committed in batches
+    of IMPORT_BATCH_SIZE documents. Jobs of workers which stopped making
+    progress for IMPORT_JOB_TIMEOUT seconds are queued again, and resumed
+    from the first batch which wasn't committed; their first workers stop
+    as soon as they notice it.
+"""
+import os
+import time
+import codecs
+import socket
+import tempfile
+import zipfile
+from datetime import datetime, timedelta
+
+from django.utils.translation import ugettext as _
+
+from wiki import settings
+from wiki.helpers import dumps, json
+from wiki.models import ImportJob, getstorage, normalize_name
+
+import logging
+logger = logging.getLogger("fnp.wiki.imports")
+
+CHUNK_SIZE = 64 * 1024
+
+
+class JobLost(Exception):
+    """The job was queued again, to be run by another worker."""
+    pass
+
+
+def spool_path():
+    """Directory of uploaded files. By default, it's in the repository's cache."""
+    return settings.IMPORT_SPOOL_PATH or \
+        getstorage().vstorage.repo.join('cache/import-spool')
+
+
+def enqueue(uploaded_file):
+    """Spool an uploaded ZIP file and queue a job importing it."""
+    directory = spool_path()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    fd, path = tempfile.mkstemp(suffix='.zip', dir=directory)
+    f = os.fdopen(fd, 'wb')
+    try:
+        for chunk in uploaded_file.chunks():
+            f.write(chunk)
+    finally:
+        f.close()
+
+    return ImportJob.objects.create(file_path=path)
+
+
+def is_utf8(zip, info):
+    """Check if a ZIP member is UTF-8 encoded, without reading it whole."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    member = zip.open(info)
+    try:
+        while True:
+            chunk = member.read(CHUNK_SIZE)
+            decoder.decode(chunk, not chunk)
+            if not chunk:
+                return True
+    except UnicodeDecodeError:
+        return False
+
+
+def check_files(zip, existing):
+    """
+    Decide which files of a ZIP are going to be imported. Returns a dict
+    of lists: 'ok_list' of (filename, title), 'skipped_list' of filenames
+    and 'error_list' of (filename, title, error).
+    """
+    skipped_list = []
+    ok_list = []
+    error_list = []
+    titles = {}
+
+    for info in zip.infolist():
+        filename = info.filename
+        if filename[-1] == '/':
+            continue
+        title = normalize_name(os.path.basename(filename)[:-4])
+        if not (title and filename.endswith('.xml')):
+            skipped_list.append(filename)
+        elif title in titles:
+            error_list.append((filename, title, _('Title already used for %s') % titles[title]))
+        elif title in existing:
+            error_list.append((filename, title, _('Title already used in repository.')))
+        else:
+            try:
+                if is_utf8(zip, info):
+                    ok_list.append((filename, title))
+                else:
+                    error_list.append((filename, title, _('File should be UTF-8 encoded.')))
+            except zipfile.BadZipfile:
+                error_list.append((filename, title, _('ZIP file corrupt.')))
+            titles[title] = filename
+
+    return {
+        'ok_list': ok_list,
+        'skipped_list': skipped_list,
+        'error_list': error_list,
+    }
+
+
+def imported_titles(job):
+    """Titles of documents committed by an earlier run of a job."""
+    if not (job.processed and job.result):
+        return set()
+    ok_list = json.loads(job.result).get('ok_list', [])
+    return set(title for filename, title in ok_list[:job.processed])
+
+
+def _update(job, **kwargs):
+    """Update a running job, unless it was taken from its worker."""
+    updated = ImportJob.objects.filter(pk=job.pk, status=ImportJob.RUNNING, worker=job.worker) \
+        .update(updated_at=datetime.now(), **kwargs)
+    if not updated:
+        raise JobLost("Import job %d was queued again" % job.pk)
+    for attr, value in kwargs.iteritems():
+        setattr(job, attr, value)
+
+
+def run_job(job):
+    """
+    Import documents from a claimed job's ZIP file. Nothing is imported
+    if any of the files is wrong; otherwise, if committing a batch fails,
+    documents from earlier batches stay in the repository, and a job
+    run again continues after them. A job queued again while it's still
+    running is left to its new worker: no more batches are committed.
+    """
+    storage = getstorage()
+    try:
+        try:
+            zip = zipfile.ZipFile(job.file_path)
+            try:
+                existing = set(storage.all()) - imported_titles(job)
+                result = check_files(zip, existing)
+                if not result['error_list']:
+                    ok_list = result['ok_list']
+                    _update(job, total=len(ok_list), result=dumps(result))
+                    for start in xrange(job.processed, len(ok_list), settings.IMPORT_BATCH_SIZE):
+                        batch = ok_list[start:start + settings.IMPORT_BATCH_SIZE]
+                        storage.create_documents((title, zip.read(filename).decode('utf-8'))
+                                                 for filename, title in batch)
+                        _update(job, processed=start + len(batch))
+            finally:
+                zip.close()
+        except JobLost:
+            raise
+        except Exception, e:
+            logger.exception("Import job %d failed", job.pk)
+            _update(job, status=ImportJob.FAILED, result=dumps({'error': unicode(e)}))
+        else:
+            _update(job, status=ImportJob.DONE, result=dumps(result))
+    except JobLost:
+        logger.warning("Import job %d was queued again, leaving it", job.pk)
+        return
+
+    try:
+        os.unlink(job.file_path)
+    except OSError:
+        pass
+
+
+def claim_job(worker):
+    """
+    Take the oldest queued job, or return None if there are none.
+    Jobs are claimed with a single UPDATE, so each is run only once
+    even with many workers.
+    """
+    queued = ImportJob.objects.filter(status=ImportJob.QUEUED)
+    for job_id in queued.values_list('pk', flat=True)[:10]:
+        claimed = ImportJob.objects.filter(pk=job_id, status=ImportJob.QUEUED).update(
+                status=ImportJob.RUNNING, worker=worker, updated_at=datetime.now())
+        if claimed:
+            return ImportJob.objects.get(pk=job_id)
+    return None
+
+
+def requeue_stale_jobs():
+    """
+    Queue again running jobs which made no progress for IMPORT_JOB_TIMEOUT
+    seconds, most likely because their workers died.
+    """
+    now = datetime.now()
+    stale = ImportJob.objects.filter(status=ImportJob.RUNNING,
+            updated_at__lt=now - timedelta(seconds=settings.IMPORT_JOB_TIMEOUT))
+    for job in stale:
+        logger.warning("Import job %d of worker %s timed out, queueing it again", job.pk, job.worker)
+    # the job could finish in the meantime
+    return stale.update(status=ImportJob.QUEUED, worker='', updated_at=now)
+
+
+def work(worker=None, poll_interval=5, once=False):
+    """Run queued jobs, waiting for new ones unless `once` is set."""
+    if worker is None:
+        worker = "%s:%d" % (socket.gethostname(), os.getpid())
+
+    while True:
+        requeue_stale_jobs()
+        job = claim_job(worker)
+        if job is not None:
+            logger.info("Worker %s running import job %d", worker, job.pk)
+            run_job(job)
+        elif once:
+            return
+        else:
+            time.sleep(poll_interval)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of FNP-Redakcja, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+from optparse import make_option
+from multiprocessing import Process
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', type='int', default=1, help='Number of worker processes to run.'),
+        make_option('--poll-interval', type='int', default=5, help='Seconds to wait between checks for new jobs.'),
+        make_option('--once', action='store_true', default=False, help='Exit when there are no more queued jobs.'),
+    )
+    help = 'Runs queued bulk imports of documents.'
+    args = ''
+
+    def handle_noargs(self, **options):
+        from wiki.imports import work
+
+        kwargs = {'poll_interval': options['poll_interval'], 'once': options['once']}
+        if options['workers'] <= 1:
+            return work(**kwargs)
+
+        # workers must not share the database connection
+        connection.close()
+        workers = [Process(target=work, kwargs=kwargs) for i in xrange(options['workers'])]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
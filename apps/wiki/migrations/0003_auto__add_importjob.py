@@ -0,0 +1,52 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+    
+    def forwards(self, orm):
+        
+        # Adding model 'ImportJob'
+        db.create_table('wiki_importjob', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('file_path', self.gf('django.db.models.fields.CharField')(max_length=255)),
+            ('status', self.gf('django.db.models.fields.CharField')(default='queued', max_length=10, db_index=True)),
+            ('worker', self.gf('django.db.models.fields.CharField')(max_length=64, blank=True)),
+            ('created_at', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, blank=True)),
+            ('updated_at', self.gf('django.db.models.fields.DateTimeField')(auto_now=True, blank=True)),
+            ('total', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('processed', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('result', self.gf('django.db.models.fields.TextField')(blank=True)),
+        ))
+        db.send_create_signal('wiki', ['ImportJob'])
+    
+    
+    def backwards(self, orm):
+        
+        # Deleting model 'ImportJob'
+        db.delete_table('wiki_importjob')
+    
+    
+    models = {
+        'wiki.importjob': {
+            'Meta': {'object_name': 'ImportJob'},
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'file_path': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'processed': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'result': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "'queued'", 'max_length': '10', 'db_index': 'True'}),
+            'total': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'updated_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'worker': ('django.db.models.fields.CharField', [], {'max_length': '64', 'blank': 'True'})
+        },
+        'wiki.theme': {
+            'Meta': {'object_name': 'Theme'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '50'})
+        }
+    }
+    
+    complete_apps = ['wiki']
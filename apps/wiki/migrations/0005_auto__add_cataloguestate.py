@@ -0,0 +1,65 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+    
+    def forwards(self, orm):
+        
+        # Adding model 'CatalogueState'
+        db.create_table('wiki_cataloguestate', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('revision', self.gf('django.db.models.fields.IntegerField')()),
+            ('node', self.gf('django.db.models.fields.CharField')(max_length=40)),
+        ))
+        db.send_create_signal('wiki', ['CatalogueState'])
+    
+    
+    def backwards(self, orm):
+        
+        # Deleting model 'CatalogueState'
+        db.delete_table('wiki_cataloguestate')
+    
+    
+    models = {
+        'wiki.catalogueentry': {
+            'Meta': {'object_name': 'CatalogueEntry'},
+            'author': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'changeset': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'}),
+            'deleted': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'group': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'modified': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'}),
+            'revision': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'stage': ('django.db.models.fields.CharField', [], {'max_length': '64', 'blank': 'True'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'wiki.cataloguestate': {
+            'Meta': {'object_name': 'CatalogueState'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'node': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'revision': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'wiki.importjob': {
+            'Meta': {'object_name': 'ImportJob'},
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'file_path': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'processed': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'result': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "'queued'", 'max_length': '10', 'db_index': 'True'}),
+            'total': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'updated_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'worker': ('django.db.models.fields.CharField', [], {'max_length': '64', 'blank': 'True'})
+        },
+        'wiki.theme': {
+            'Meta': {'object_name': 'Theme'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '50'})
+        }
+    }
+    
+    complete_apps = ['wiki']
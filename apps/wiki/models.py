@@ -6,14 +6,22 @@
 from django.db import models
 import re
 import os
+import bisect
+import Queue
+import threading
 import vstorage
 from vstorage import DocumentNotFound
 from wiki import settings, constants
+from wiki.cache import get_cache
+from wiki.helpers import dumps, format_datetime, gzip_string, fold
+from wiki.nice_diff import diff_hunks, render_rows
+from wiki.scans import scan_uploaded
 
 from django.contrib.auth.models import User as DjangoUser
 from django.utils.translation import ugettext_lazy as _
 
 from django.http import Http404
+from filebrowser.views import filebrowser_post_upload
 
 import logging
 logger = logging.getLogger("fnp.wiki")
@@ -44,19 +52,23 @@ STAGE_TAGS_RE = re.compile(r'^#stage-finished: (.*)$', re.MULTILINE)
 
 class DocumentStorage(object):
     def __init__(self, path):
-        self.vstorage = vstorage.VersionedStorage(path)
+        self.path = path
+        self.vstorage = vstorage.VersionedStorage(path, bare=settings.REPOSITORY_BARE)
 
     def get(self, name, revision=None):
         text, rev = self.vstorage.page_text(name, revision)
         return Document(self, name=name, text=text, revision=rev)
 
+    def current_revision(self, name):
+        return self.vstorage.page_revision(name)
+
     def get_by_tag(self, name, tag):
         text, rev = self.vstorage.page_text_by_tag(name, tag)
         return Document(self, name=name, text=text, revision=rev)
 
     def revert(self, name, revision, author):
-        text, rev = self.vstorage.revert(name, revision,
-                author=author, comment=_("Text reverted to version %d") % int(revision))
+        text, rev = self._commit('revert', name, revision,
+                author=author, comment=unicode(_("Text reverted to version %d") % int(revision)))
         return Document(self, name=name, text=text, revision=rev)
 
     def get_or_404(self, *args, **kwargs):
@@ -66,15 +78,18 @@ class DocumentStorage(object):
             raise Http404
 
     def put(self, document, author, comment, parent=None):
-        self.vstorage.save_text(
+        """
+        Save a document as a change to its `parent` revision. Returns its
+        new revision and whether the change was merged with changes saved
+        since `parent`.
+        """
+        return self._commit('save_text',
                 title=document.name,
                 text=document.text,
                 author=author,
                 comment=comment,
                 parent=parent)
 
-        return document
-
     def create_document(self, text, name):
         title = u', '.join(p.title() for p in split_name(name))
 
@@ -82,25 +97,129 @@ class DocumentStorage(object):
             text = u''
 
         document = Document(self, name=name, text=text, title=title)
-        return self.put(document, u"<wiki>", u"Document created.")
+        document.revision, merged = self.put(document, u"<wiki>", u"Document created.")
+        return document
+
+    def create_documents(self, documents, separate=False):
+        """
+        Create many documents from (name, text) pairs at once, in a single
+        changeset or, if `separate` is set, in one changeset per document.
+        """
+        if separate:
+            comment = u"Document created."
+        else:
+            comment = u"Documents created."
+        self._commit('save_many', [(name, text or u'') for name, text in documents],
+                author=u"<wiki>", comment=comment, separate=separate)
 
     def delete(self, name, author, comment):
-        self.vstorage.delete_page(name, author, comment)
+        self._commit('delete_page', name, author, comment)
+
+    def _commit(self, method, *args, **kwargs):
+        """
+        Make a change to the repository through its commit queue, so that
+        concurrent saves are serialized in a single writer thread.
+        """
+        result = vstorage.queue_commit(self.vstorage.path, method, *args, **kwargs)
+        # see the change in this thread's repository too
+        self.vstorage.refresh()
+        return result
 
     def all(self):
         return list(self.vstorage.all_pages())
 
-    def history(self, title):
+    def diff(self, name, revA, revB):
+        """
+        Return a list of hunks of changes between two revisions of
+        a document, each rendered to HTML table rows (see
+        nice_diff.render_table). Revisions never change, so the hunks
+        are cached.
+        """
+        key = (self.path, name, revA, revB)
+        hunks = _diff_cache.get(key)
+        if hunks is None:
+            docA = self.get(name, revA)
+            docB = self.get(name, revB)
+            hunks = [render_rows(hunk) for hunk in diff_hunks(
+                        docA.plain_text.splitlines(), docB.plain_text.splitlines(), context=3)]
+            _diff_cache.set(key, hunks)
+        return hunks
+
+    def prepare_diff(self, name, revA, revB):
+        """
+        Compute a diff in the background, so that it's already cached
+        when someone asks for it. Doesn't wait for it.
+        """
+        global _diff_thread
+        _diff_thread_lock.acquire()
+        try:
+            if _diff_thread is None:
+                _diff_thread = threading.Thread(target=_prepare_diffs, name="wiki diffs")
+                _diff_thread.setDaemon(True)
+                _diff_thread.start()
+        finally:
+            _diff_thread_lock.release()
+        _diff_queue.put((self.path, name, revA, revB))
+
+    def history(self, title, offset=0, limit=None):
+        """
+        Iterate over the document's history, ready to be sent to clients:
+        dates are formatted and stage markers translated.
+        """
+        return self._describe(self.vstorage.page_history(title, offset, limit))
+
+    def global_history(self, **kwargs):
+        """
+        Iterate over changesets of all documents, like `history`.
+        See VersionedStorage.history for arguments.
+        """
+        return self._describe(self.vstorage.history(**kwargs))
+
+    def _describe(self, changesets):
+        stage_descriptions = {}
+
         def stage_desc(match):
             stage = match.group(1)
-            return _("Finished stage: %s") % constants.DOCUMENT_STAGES_DICT[stage]
-
-        for changeset in self.vstorage.page_history(title):
-            changeset['description'] = STAGE_TAGS_RE.sub(stage_desc, changeset['description'])
+            try:
+                return stage_descriptions[stage]
+            except KeyError:
+                # translate every stage name only once
+                desc = stage_descriptions[stage] = unicode(
+                        _("Finished stage: %s") % constants.DOCUMENT_STAGES_DICT[stage])
+                return desc
+
+        for changeset in changesets:
+            if '#stage-finished' in changeset['description']:
+                changeset['description'] = STAGE_TAGS_RE.sub(stage_desc, changeset['description'])
+            changeset['date'] = format_datetime(changeset['date'])
             yield changeset
 
 
 
+_rendered_cache = get_cache('rendered', 32 * 1024 * 1024)
+_diff_cache = get_cache('diff', 16 * 1024 * 1024)
+
+# diffs to compute in the background, see DocumentStorage.prepare_diff
+_diff_queue = Queue.Queue()
+_diff_thread = None
+_diff_thread_lock = threading.Lock()
+
+def _prepare_diffs():
+    # the thread's own storages, repositories aren't thread-safe
+    storages = {}
+    while True:
+        path, name, revA, revB = _diff_queue.get()
+        try:
+            storage = storages.get(path)
+            if storage is None:
+                storage = storages[path] = DocumentStorage(path)
+            else:
+                storage.vstorage.refresh()
+            storage.diff(name, revA, revB)
+        except Exception:
+            logger.exception("Unable to prepare diff of %r (%r, %r)", name, revA, revB)
+        _diff_queue.task_done()
+
 class Document(object):
     META_REGEX = re.compile(r'\s*<!--\s(.*?)-->', re.DOTALL | re.MULTILINE)
 
@@ -108,17 +227,70 @@ class Document(object):
         self.storage = storage
         for attr, value in kwargs.iteritems():
             setattr(self, attr, value)
+        # text as read from the storage; renderings of it are cached
+        self._stored_text = kwargs.get('text') if 'revision' in kwargs else None
 
     def add_tag(self, tag, revision, author):
         """ Add document specific tag """
         logger.debug("Adding tag %s to doc %s version %d", tag, self.name, revision)
-        self.storage.vstorage.add_page_tag(self.name, revision, tag, user=author)
+        self.storage._commit('add_page_tag', self.name, revision, tag, user=author)
+
+    def rendered(self):
+        """
+        Return a dict with the document's text stripped of metadata
+        ('plain_text'), parsed metadata ('meta') and the JSON payload sent
+        to the editor ('json'). For unmodified stored revisions
+        the result is cached.
+        """
+        key = self._cache_key()
+        if key is None:
+            return self._render()
+
+        rendered = _rendered_cache.get(key)
+        if rendered is None:
+            rendered = self._render()
+            _rendered_cache.set(key, rendered)
+        return rendered
+
+    def gzipped_json(self):
+        """Return the editor's JSON payload compressed with gzip, cached like `rendered`."""
+        key = self._cache_key()
+        if key is None:
+            return gzip_string(self.rendered()['json'])
+
+        key += ('gzip',)
+        data = _rendered_cache.get(key)
+        if data is None:
+            data = gzip_string(self.rendered()['json'])
+            _rendered_cache.set(key, data)
+        return data
+
+    def _cache_key(self):
+        if self._stored_text is None or self.text is not self._stored_text:
+            return None
+        return (self.storage.path, self.name, self.revision)
+
+    def _render(self):
+        plain_text = re.sub(self.META_REGEX, '', self.text, 1)
+        meta = self._parse_meta()
+        return {
+            'plain_text': plain_text,
+            'meta': meta,
+            'json': dumps({
+                'text': plain_text,
+                'meta': meta,
+                'revision': getattr(self, 'revision', None),
+            }),
+        }
 
     @property
     def plain_text(self):
-        return re.sub(self.META_REGEX, '', self.text, 1)
+        return self.rendered()['plain_text']
 
     def meta(self):
+        return dict(self.rendered()['meta'])
+
+    def _parse_meta(self):
         result = {}
 
         m = re.match(self.META_REGEX, self.text)
@@ -141,8 +313,22 @@ class Document(object):
     def info(self):
         return self.storage.vstorage.page_meta(self.name, self.revision)
 
+_local = threading.local()
+
 def getstorage():
-    return DocumentStorage(settings.REPOSITORY_PATH)
+    """
+    Return the storage for the configured repository.
+
+    Opening a Mercurial repository is expensive, so the storage is kept
+    around between requests and only refreshed when the changelog changes.
+    Repository objects aren't thread-safe, so every thread gets its own.
+    """
+    storage = getattr(_local, 'storage', None)
+    if storage is None or storage.path != settings.REPOSITORY_PATH:
+        storage = _local.storage = DocumentStorage(settings.REPOSITORY_PATH)
+    else:
+        storage.vstorage.refresh()
+    return storage
 
 #
 # Django models
@@ -162,6 +348,125 @@ class Theme(models.Model):
     def __repr__(self):
         return "Theme(name=%r)" % self.name
 
+
+class ThemeIndex(object):
+    """
+    Theme names sorted by their folded forms, for finding them by prefix
+    regardless of case and diacritics without querying the database.
+    Loaded on first use and dropped when themes change (in this process:
+    other processes see the change only after a restart).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = None
+        self._names = None
+
+    def invalidate(self, **kwargs):
+        self._lock.acquire()
+        try:
+            self._keys = self._names = None
+        finally:
+            self._lock.release()
+
+    def _load(self):
+        self._lock.acquire()
+        try:
+            if self._keys is None:
+                pairs = sorted((fold(name), name) for name in
+                               Theme.objects.values_list('name', flat=True))
+                self._names = [name for key, name in pairs]
+                self._keys = [key for key, name in pairs]
+            return self._keys, self._names
+        finally:
+            self._lock.release()
+
+    def find(self, prefix=u'', limit=None):
+        """Names of themes starting with `prefix`, at most `limit` of them."""
+        keys, names = self._load()
+        prefix = fold(prefix)
+        start = bisect.bisect_left(keys, prefix)
+        end = start
+        while end < len(keys) and keys[end].startswith(prefix) and \
+                (limit is None or end - start < limit):
+            end += 1
+        return names[start:end]
+
+theme_index = ThemeIndex()
+models.signals.post_save.connect(theme_index.invalidate, sender=Theme)
+models.signals.post_delete.connect(theme_index.invalidate, sender=Theme)
+
+filebrowser_post_upload.connect(scan_uploaded)
+
+
+class ImportJob(models.Model):
+    """A ZIP file of documents waiting to be imported, see wiki.imports."""
+    QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, _('queued')),
+        (RUNNING, _('running')),
+        (DONE, _('done')),
+        (FAILED, _('failed')),
+    )
+
+    file_path = models.CharField(_('file path'), max_length=255)
+    status = models.CharField(_('status'), max_length=10, choices=STATUS_CHOICES,
+                              default=QUEUED, db_index=True)
+    worker = models.CharField(_('worker'), max_length=64, blank=True)
+    created_at = models.DateTimeField(_('created at'), auto_now_add=True)
+    updated_at = models.DateTimeField(_('updated at'), auto_now=True)
+    total = models.PositiveIntegerField(_('total'), default=0)
+    processed = models.PositiveIntegerField(_('processed'), default=0)
+    # JSON with lists of imported, skipped and offending files
+    result = models.TextField(_('result'), blank=True)
+
+    class Meta:
+        ordering = ('created_at',)
+        verbose_name = _('import job')
+        verbose_name_plural = _('import jobs')
+
+    def __unicode__(self):
+        return u"%s (%s)" % (os.path.basename(self.file_path), self.status)
+
+class CatalogueEntry(models.Model):
+    """Document as listed in the catalogue, see wiki.catalogue."""
+    name = models.CharField(_('name'), max_length=255, unique=True)
+    # first part of the name, documents are grouped by it
+    group = models.CharField(_('group'), max_length=255, db_index=True)
+    title = models.CharField(_('title'), max_length=255)
+    revision = models.IntegerField(_('revision'), default=0)
+    # repository revision of the last change
+    changeset = models.IntegerField(_('changeset'), db_index=True)
+    author = models.CharField(_('author'), max_length=255, blank=True)
+    modified = models.DateTimeField(_('modified'), null=True)
+    stage = models.CharField(_('stage'), max_length=64, blank=True)
+    deleted = models.BooleanField(_('deleted'), default=False)
+
+    class Meta:
+        # regrouping needs entries sorted by group
+        ordering = ('group', 'name')
+        verbose_name = _('catalogue entry')
+        verbose_name_plural = _('catalogue entries')
+
+    def __unicode__(self):
+        return self.name
+
+    def stage_name(self):
+        return constants.DOCUMENT_STAGES_DICT.get(self.stage, u'')
+
+class CatalogueState(models.Model):
+    """Repository revision the catalogue is up to date with, see wiki.catalogue."""
+    revision = models.IntegerField(_('revision'))
+    # tells if the repository's history was rewritten since
+    node = models.CharField(_('node'), max_length=40)
+
+    class Meta:
+        verbose_name = _('catalogue state')
+        verbose_name_plural = _('catalogue states')
+
+    def __unicode__(self):
+        return u"%d:%s" % (self.revision, self.node[:12])
+
 # App-wide profile for the user
 class WikiUser(DjangoUser):
 
@@ -3,6 +3,7 @@
 # This file is part of FNP-Redakcja, licensed under GNU Affero GPLv3 or later.
 # Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
 #
+import bisect
 import difflib
 import re
 from collections import deque
@@ -13,6 +14,22 @@ from django.utils.html import escape as html_escape
 DIFF_RE = re.compile(r"""\x00([+^-])""", re.UNICODE)
 NAMES = {'+': 'added', '-': 'removed', '^': 'changed'}
 
+# Replaced blocks longer than this (in lines) are shown without
+# highlighting changes within lines, which is quadratic.
+INTRALINE_LIMIT = 50
+
+NO_LINE = ('', '\n')
+
+ROW_TEMPLATE = u"""<tr class="%s">
+<td>%s</td>
+<td class="left">%s&nbsp;</td>
+<td>%s</td>
+<td class="right">%s&nbsp;</td>
+</tr>
+"""
+
+SEPARATOR_ROW = ROW_TEMPLATE % ('', 0, '-----', 0, '-----')
+
 
 def diff_replace(match):
     return """<span class="diff_mark diff_mark_%s">""" % NAMES[match.group(1)]
@@ -26,36 +43,231 @@ def format_changeset(a, b, change):
     return (a[0], filter_line(a[1]), b[0], filter_line(b[1]), change)
 
 
-def html_diff_table(la, lb, context=None):
-    all_changes = difflib._mdiff(la, lb)
+def _offset(line, offset):
+    if line[0] == '':
+        return line
+    return (line[0] + offset, line[1])
 
-    if context is None:
-        changes = (format_changeset(*c) for c in all_changes)
-    else:
-        changes = []
-        q = deque()
-        after_change = False
-
-        for changeset in all_changes:
-            q.append(changeset)
-
-            if changeset[2]:
-                after_change = True
-                if not after_change:
-                    changes.append((0, '-----', 0, '-----', False))
-                changes.extend(format_changeset(*c) for c in q)
-                q.clear()
+
+def _replaced(la, lb, a0, b0, intraline_limit):
+    """Changes for a block of lines of `la` replaced by lines of `lb`."""
+    if intraline_limit is None or max(len(la), len(lb)) <= intraline_limit:
+        for a, b, change in difflib._mdiff(la, lb):
+            yield _offset(a, a0), _offset(b, b0), change
+        return
+
+    for i in xrange(max(len(la), len(lb))):
+        a = i < len(la) and (a0 + i + 1, '\0-%s\1' % la[i]) or NO_LINE
+        b = i < len(lb) and (b0 + i + 1, '\0+%s\1' % lb[i]) or NO_LINE
+        yield a, b, True
+
+
+def _patience_blocks(a, alo, ahi, b, blo, bhi, blocks):
+    """
+    Append matching blocks (i, j, size) of a[alo:ahi] and b[blo:bhi] to
+    `blocks`, using patience diff: lines occurring exactly once on both
+    sides are used as anchors, and gaps between them are matched
+    recursively. Gaps without such lines fall back to SequenceMatcher.
+    """
+    prefix = 0
+    while alo + prefix < ahi and blo + prefix < bhi and a[alo + prefix] == b[blo + prefix]:
+        prefix += 1
+    if prefix:
+        blocks.append((alo, blo, prefix))
+        alo += prefix
+        blo += prefix
+
+    suffix = 0
+    while suffix < min(ahi - alo, bhi - blo) and a[ahi - suffix - 1] == b[bhi - suffix - 1]:
+        suffix += 1
+    ahi -= suffix
+    bhi -= suffix
+
+    if alo < ahi and blo < bhi:
+        # line -> [count in a, index in a, count in b, index in b]
+        lines = {}
+        for i in xrange(alo, ahi):
+            entry = lines.get(a[i])
+            if entry is None:
+                lines[a[i]] = [1, i, 0, None]
+            else:
+                entry[0] += 1
+        for j in xrange(blo, bhi):
+            entry = lines.get(b[j])
+            if entry is not None:
+                entry[2] += 1
+                entry[3] = j
+        unique = sorted((i, j) for count_a, i, count_b, j in lines.itervalues()
+                        if count_a == 1 and count_b == 1)
+
+        # longest increasing subsequence of b indexes
+        tails, tail_indexes, backlinks = [], [], []
+        for n, (i, j) in enumerate(unique):
+            k = bisect.bisect_left(tails, j)
+            if k == len(tails):
+                tails.append(j)
+                tail_indexes.append(n)
             else:
-                if len(q) == context and after_change:
-                    changes.extend(format_changeset(*c) for c in q)
-                    q.clear()
-                    after_change = False
-                elif len(q) > context:
-                    q.popleft()
+                tails[k] = j
+                tail_indexes[k] = n
+            if k:
+                backlinks.append(tail_indexes[k - 1])
+            else:
+                backlinks.append(None)
+        anchors = []
+        if tail_indexes:
+            n = tail_indexes[-1]
+            while n is not None:
+                anchors.append(unique[n])
+                n = backlinks[n]
+            anchors.reverse()
+
+        if anchors:
+            anchors.append((ahi, bhi))
+            for i, j in anchors:
+                if alo < i or blo < j:
+                    _patience_blocks(a, alo, i, b, blo, j, blocks)
+                if i < ahi:
+                    blocks.append((i, j, 1))
+                alo, blo = i + 1, j + 1
+        else:
+            matcher = difflib.SequenceMatcher(None, a[alo:ahi], b[blo:bhi])
+            for i, j, size in matcher.get_matching_blocks():
+                if size:
+                    blocks.append((alo + i, blo + j, size))
 
+    if suffix:
+        blocks.append((ahi, bhi, suffix))
+
+
+def line_opcodes(a, b):
+    """
+    Like SequenceMatcher(None, a, b).get_opcodes(), but much faster
+    for long texts with few changes. Lines are aligned by patience diff,
+    so where lines repeat or move, the opcodes may differ from
+    SequenceMatcher's.
+
+    >>> line_opcodes(['a', 'b', 'c', 'd'], ['a', 'c', 'x', 'd'])
+    [('equal', 0, 1, 0, 1), ('delete', 1, 2, 1, 1), ('equal', 2, 3, 1, 2), ('insert', 3, 3, 2, 3), ('equal', 3, 4, 3, 4)]
+    """
+    blocks = []
+    _patience_blocks(a, 0, len(a), b, 0, len(b), blocks)
+    blocks.append((len(a), len(b), 0))
+
+    opcodes = []
+    i = j = 0
+    equal_from = None
+    for ai, bj, size in blocks:
+        if i < ai or j < bj:
+            if equal_from is not None:
+                opcodes.append(('equal', equal_from[0], i, equal_from[1], j))
+                equal_from = None
+            if i < ai and j < bj:
+                opcodes.append(('replace', i, ai, j, bj))
+            elif i < ai:
+                opcodes.append(('delete', i, ai, j, j))
+            else:
+                opcodes.append(('insert', i, i, j, bj))
+        if size and equal_from is None:
+            equal_from = (ai, bj)
+        i, j = ai + size, bj + size
+    if equal_from is not None:
+        opcodes.append(('equal', equal_from[0], i, equal_from[1], j))
+    return opcodes
+
+
+def diff_changes(la, lb, intraline_limit=INTRALINE_LIMIT):
+    """
+    Compare two lists of lines, yielding changes in the same format
+    as difflib._mdiff: ((line number, text), (line number, text), changed).
+
+    Lines are matched with patience diff (see `line_opcodes`), and only
+    replaced blocks no longer than `intraline_limit` lines get their
+    changes within lines marked.
+
+    >>> list(diff_changes(['a', 'b', 'c'], ['a', 'B', 'c', 'd']))
+    [((1, 'a'), (1, 'a'), False), ((2, '\\x00-b\\x01'), (2, '\\x00+B\\x01'), True), ((3, 'c'), (3, 'c'), False), (('', '\\n'), (4, '\\x00+d\\x01'), True)]
+    """
+    for tag, i1, i2, j1, j2 in line_opcodes(la, lb):
+        if tag == 'equal':
+            for i in xrange(i2 - i1):
+                yield (i1 + i + 1, la[i1 + i]), (j1 + i + 1, lb[j1 + i]), False
+        elif tag == 'delete':
+            for i in xrange(i1, i2):
+                yield (i + 1, '\0-%s\1' % la[i]), NO_LINE, True
+        elif tag == 'insert':
+            for j in xrange(j1, j2):
+                yield NO_LINE, (j + 1, '\0+%s\1' % lb[j]), True
+        else:
+            for change in _replaced(la[i1:i2], lb[j1:j2], i1, j1, intraline_limit):
+                yield change
+
+
+def render_rows(changes):
+    return u''.join(ROW_TEMPLATE % (has_change and 'change' or '', an, a, bn, b)
+                    for an, a, bn, b, has_change in changes)
+
+
+def diff_hunks(la, lb, context=None, intraline_limit=INTRALINE_LIMIT):
+    """
+    Group changes between two lists of lines into hunks: runs of changed
+    rows with up to `context` unchanged rows around them. Each hunk is
+    a list of rows as returned by `format_changeset`. Without `context`,
+    all rows are returned as a single hunk.
+
+    >>> [[row[0] for row in hunk] for hunk in diff_hunks(list('abcdefgh'), list('aBcdefgH'), context=1)]
+    [[1, 2, 3], [7, 8]]
+    """
+    all_changes = diff_changes(la, lb, intraline_limit)
+
+    if context is None:
+        return [[format_changeset(*c) for c in all_changes]]
+
+    hunks = []
+    hunk = None
+    unchanged = deque()
+
+    for changeset in all_changes:
+        if changeset[2]:
+            if hunk is None:
+                hunk = []
+                hunks.append(hunk)
+            hunk.extend(format_changeset(*c) for c in unchanged)
+            unchanged.clear()
+            hunk.append(format_changeset(*changeset))
+        else:
+            unchanged.append(changeset)
+            if hunk is not None and len(unchanged) > 2 * context:
+                # too far from the next change to join the hunks
+                for i in xrange(context):
+                    hunk.append(format_changeset(*unchanged.popleft()))
+                hunk = None
+            while hunk is None and len(unchanged) > context:
+                unchanged.popleft()
+
+    if hunk is not None:
+        hunk.extend(format_changeset(*c) for c in list(unchanged)[:context])
+
+    return hunks
+
+
+def render_table(hunks, hunk_from=0, hunk_count=None):
+    """
+    Render a diff table of already rendered hunks (see `render_rows`),
+    which are `hunk_from`.. of `hunk_count` hunks in total.
+    """
+    if hunk_count is None:
+        hunk_count = len(hunks)
     return render_to_string("wiki/diff_table.html", {
-        "changes": changes,
+        "rows": SEPARATOR_ROW.join(hunks),
+        "hunk_from": hunk_from,
+        "hunk_count": hunk_count,
     })
 
 
+def html_diff_table(la, lb, context=None, intraline_limit=INTRALINE_LIMIT):
+    hunks = diff_hunks(la, lb, context, intraline_limit)
+    return render_table([render_rows(hunk) for hunk in hunks])
+
+
 __all__ = ['html_diff_table']
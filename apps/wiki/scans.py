@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of FNP-Redakcja, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+"""
+    Renditions of gallery scans, so the editor doesn't need to download
+    full-size scans: filebrowser versions in sizes listed in
+    WIKI_GALLERY_VERSIONS and Deep Zoom tile pyramids.
+
+    Both are made in the background when scans are uploaded with
+    filebrowser: versions by filebrowser's queue (see filebrowser.versioning),
+    pyramids in a pool of processes of their own. Pyramids are kept with
+    filebrowser's versions; a scan's pyramid is complete once its .dzi
+    descriptor is there.
+"""
+import os
+import math
+import threading
+import multiprocessing
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+from filebrowser.fb_settings import MEDIA_ROOT, VERSIONS_BASEDIR
+from filebrowser.versioning import queue_version
+
+from wiki import settings
+
+import logging
+logger = logging.getLogger("fnp.wiki.scans")
+
+TILE_FORMAT = 'jpg'
+TILE_QUALITY = 85
+
+DZI_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="%(format)s" Overlap="0" TileSize="%(tile_size)d">
+<Size Width="%(width)d" Height="%(height)d"/>
+</Image>
+"""
+
+
+def pyramid_path(path):
+    """
+    Paths of the Deep Zoom descriptor and tiles directory of a scan,
+    relative to MEDIA_ROOT like the scan's own `path`.
+
+    >>> pyramid_path(u'images/scans/001.jpg') == (
+    ...     os.path.join(VERSIONS_BASEDIR, u'images/scans/001.dzi'),
+    ...     os.path.join(VERSIONS_BASEDIR, u'images/scans/001_files'))
+    True
+    """
+    base = os.path.join(VERSIONS_BASEDIR, os.path.splitext(path)[0])
+    return base + u'.dzi', base + u'_files'
+
+
+def pyramid_levels(width, height):
+    """
+    Number of levels in a pyramid of an image: the last one is the image
+    itself, each one before it has half its size, the first is 1x1.
+
+    >>> pyramid_levels(1, 1), pyramid_levels(1000, 600), pyramid_levels(1024, 10)
+    (1, 11, 11)
+    """
+    return int(math.ceil(math.log(max(width, height), 2))) + 1
+
+
+def make_pyramid(path, tile_size=None):
+    """Cut a scan into Deep Zoom tiles, at all levels."""
+    if tile_size is None:
+        tile_size = settings.GALLERY_TILE_SIZE
+    descriptor, tiles_dir = [os.path.join(MEDIA_ROOT, p) for p in pyramid_path(path)]
+
+    im = Image.open(os.path.join(MEDIA_ROOT, path))
+    if im.mode != 'RGB':
+        im = im.convert('RGB')
+    width, height = im.size
+
+    levels = pyramid_levels(width, height)
+    for level in xrange(levels - 1, -1, -1):
+        scale = 2 ** (levels - 1 - level)
+        size = (int(math.ceil(float(width) / scale)), int(math.ceil(float(height) / scale)))
+        if im.size != size:
+            # each level is made from the one above it
+            im = im.resize(size, Image.ANTIALIAS)
+
+        level_dir = os.path.join(tiles_dir, str(level))
+        if not os.path.isdir(level_dir):
+            os.makedirs(level_dir)
+        for column in xrange(int(math.ceil(float(size[0]) / tile_size))):
+            for row in xrange(int(math.ceil(float(size[1]) / tile_size))):
+                box = (column * tile_size, row * tile_size,
+                       min((column + 1) * tile_size, size[0]),
+                       min((row + 1) * tile_size, size[1]))
+                im.crop(box).save(os.path.join(level_dir, '%d_%d.%s' % (column, row, TILE_FORMAT)),
+                                  quality=TILE_QUALITY)
+
+    # the descriptor marks the pyramid as complete
+    f = open(descriptor + '.tmp', 'w')
+    try:
+        f.write(DZI_TEMPLATE % {'format': TILE_FORMAT, 'tile_size': tile_size,
+                                'width': width, 'height': height})
+    finally:
+        f.close()
+    os.rename(descriptor + '.tmp', descriptor)
+
+
+def render_pyramid(path):
+    """
+    Make the tile pyramid of a scan, given its path relative to MEDIA_ROOT.
+    Returns True if it was made.
+    """
+    try:
+        make_pyramid(path)
+    except (IOError, OSError):
+        logger.exception("Unable to make tiles of %r", path)
+        return False
+    return True
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def queue_scan(path):
+    """
+    Make versions of a scan and its tile pyramid in the background. Tiles
+    are made in one of WIKI_GALLERY_RENDER_PROCESSES processes, or right
+    away if it's 0.
+    """
+    global _pool
+    for version in settings.GALLERY_VERSIONS:
+        queue_version(path, version, force=True)
+
+    if not settings.GALLERY_RENDER_PROCESSES:
+        render_pyramid(path)
+        return
+
+    _pool_lock.acquire()
+    try:
+        if _pool is None:
+            _pool = multiprocessing.Pool(settings.GALLERY_RENDER_PROCESSES)
+    finally:
+        _pool_lock.release()
+    _pool.apply_async(render_pyramid, (path,))
+
+
+def scan_uploaded(sender, path, file, **kwargs):
+    """Queue rendering of images uploaded with filebrowser."""
+    if file.filetype == 'Image':
+        logger.debug("Queueing renditions of %r", file.path)
+        queue_scan(file.path)
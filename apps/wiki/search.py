@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of FNP-Redakcja, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+"""
+    Full-text search over current texts of documents.
+
+    Texts are indexed in an SQLite FTS table, folded (see helpers.fold),
+    so searching ignores case and diacritics. The index remembers
+    the repository revision it's up to date with, and is refreshed
+    with documents changed since then before each search, in batches
+    of BATCH_SIZE. The node of that revision is remembered too: if it
+    doesn't match the repository any more, its history was rewritten
+    and the index is rebuilt. Snippets are cut from current texts,
+    read only for the results shown.
+"""
+import os
+import re
+import sqlite3
+
+from wiki import settings
+from wiki.helpers import fold
+
+import logging
+logger = logging.getLogger("fnp.wiki.search")
+
+# Characters of text shown around a match.
+SNIPPET_CONTEXT = 80
+
+# Documents indexed in one transaction.
+BATCH_SIZE = 100
+
+TERM_RE = re.compile(r'"([^"]*)"|(\S+)', re.UNICODE)
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+SCHEMA = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS documents USING fts4(text);
+    CREATE TABLE IF NOT EXISTS names (name TEXT PRIMARY KEY);
+    CREATE TABLE IF NOT EXISTS state (revision INTEGER, node TEXT);
+"""
+
+
+def parse_query(query):
+    """
+    Split a query into terms: words, or phrases in double quotes.
+    Returns a list of lists of folded words.
+
+    >>> parse_query(u'Pan "Tadeusz, czyli" -')
+    [[u'pan'], [u'tadeusz', u'czyli']]
+    """
+    terms = []
+    for phrase, word in TERM_RE.findall(fold(query)):
+        words = WORD_RE.findall(phrase or word)
+        if words:
+            terms.append(words)
+    return terms
+
+
+def index_text(text):
+    """
+    Folded words of a text, separated with spaces: FTS's tokenizer
+    would take non-ASCII punctuation, like Polish quotes, for letters.
+
+    >>> index_text(u'<akap>\\u201eLitwo!</akap>')
+    u'akap litwo akap'
+    """
+    return u' '.join(WORD_RE.findall(fold(text)))
+
+
+def match_expression(terms):
+    return u' '.join(u'"%s"' % u' '.join(words) for words in terms)
+
+
+def term_regex(words):
+    return re.compile(r'\b%s\b' % r'\W+'.join(re.escape(word) for word in words), re.UNICODE)
+
+
+def snippet(text, terms, context=SNIPPET_CONTEXT):
+    """
+    Cut a fragment of `text` around the first match of any of `terms`.
+    Returns the fragment and a list of (start, end) positions of matches
+    within it.
+
+    >>> snippet(u'Litwo! Ojczyzno moja! Ty jestes jak zdrowie.', [[u'ojczyzno', u'moja']], 10)
+    (u'Litwo! Ojczyzno moja! Ty je', [(7, 20)])
+    """
+    folded = fold(text)
+    regexes = [term_regex(words) for words in terms]
+
+    first = [match.start() for match in (regex.search(folded) for regex in regexes) if match]
+    if not first:
+        return text[:2 * context], []
+    start = max(0, min(first) - context)
+    end = min(len(text), min(first) + 2 * context)
+
+    matches = []
+    for regex in regexes:
+        for match in regex.finditer(folded, start, end):
+            matches.append((match.start() - start, min(match.end(), end) - start))
+    matches.sort()
+    return text[start:end], matches
+
+
+class SearchIndex(object):
+    """Full-text index of documents in a DocumentStorage."""
+
+    def __init__(self, storage, path=None):
+        self.storage = storage
+        if path is None:
+            path = settings.SEARCH_INDEX_PATH or \
+                storage.vstorage.repo.join('cache/wiki-search.db')
+        self.path = path
+
+    def connect(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # transactions are handled explicitly
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(state)")]
+        if columns and 'node' not in columns:
+            # made before nodes were remembered, it's rebuilt
+            connection.executescript("DROP TABLE state;")
+        connection.executescript(SCHEMA)
+        return connection
+
+    def _state(self, connection):
+        """The indexed revision and its node, or (None, None)."""
+        return connection.execute("SELECT revision, node FROM state").fetchone() or (None, None)
+
+    def _index(self, connection, name):
+        # documents are indexed by rowids of their names
+        vstorage = self.storage.vstorage
+        row = connection.execute("SELECT rowid FROM names WHERE name = ?", (name,)).fetchone()
+        if row is not None:
+            connection.execute("DELETE FROM documents WHERE docid = ?", row)
+        if name not in vstorage:
+            if row is not None:
+                connection.execute("DELETE FROM names WHERE rowid = ?", row)
+            return
+
+        if row is None:
+            docid = connection.execute("INSERT INTO names (name) VALUES (?)", (name,)).lastrowid
+        else:
+            docid = row[0]
+        connection.execute("INSERT INTO documents (docid, text) VALUES (?, ?)",
+                           (docid, index_text(vstorage.page_text(name)[0])))
+
+    def refresh(self):
+        """Index documents changed since the indexed revision."""
+        vstorage = self.storage.vstorage
+
+        connection = self.connect()
+        try:
+            while True:
+                # see commits of other processes, which may have indexed them
+                vstorage.refresh()
+                tip = vstorage.repo_revision()
+                state = self._state(connection)
+                revision, node = state
+                if revision is not None and vstorage.revision_node(revision) != node:
+                    logger.warning("Search index doesn't match the repository, rebuilding it")
+                    since = None
+                elif revision is not None and revision >= tip:
+                    return
+                else:
+                    since = revision
+
+                names, cursor = vstorage.changed_since(since, BATCH_SIZE)
+                # writers are serialized, so check if another one was faster
+                connection.execute("BEGIN IMMEDIATE")
+                try:
+                    if tuple(self._state(connection)) != tuple(state):
+                        connection.execute("ROLLBACK")
+                        continue
+
+                    if since is None:
+                        connection.execute("DELETE FROM documents")
+                        connection.execute("DELETE FROM names")
+                    logger.debug("Indexing %d documents up to revision %d", len(names), cursor)
+                    for name in names:
+                        self._index(connection, name)
+                    connection.execute("DELETE FROM state")
+                    connection.execute("INSERT INTO state (revision, node) VALUES (?, ?)",
+                                       (cursor, vstorage.revision_node(cursor)))
+                    connection.execute("COMMIT")
+                except:
+                    connection.execute("ROLLBACK")
+                    raise
+        finally:
+            connection.close()
+
+    def search(self, query, offset=0, limit=20):
+        """
+        Find documents containing all words and phrases of a query.
+        Returns a list of dicts with document `name`, `revision`,
+        a `snippet` of its text around a match and `matches`, positions
+        of matches within the snippet.
+        """
+        terms = parse_query(query)
+        if not terms:
+            return []
+
+        self.refresh()
+        connection = self.connect()
+        try:
+            names = [row[0] for row in connection.execute(
+                    "SELECT name FROM names JOIN documents ON docid = names.rowid "
+                    "WHERE text MATCH ? ORDER BY name LIMIT ? OFFSET ?",
+                    (match_expression(terms), limit, offset))]
+        finally:
+            connection.close()
+
+        results = []
+        for name in names:
+            text, revision = self.storage.vstorage.page_text(name)
+            fragment, matches = snippet(text, terms)
+            results.append({
+                "name": name,
+                "revision": revision,
+                "snippet": fragment,
+                "matches": matches,
+            })
+        return results
@@ -4,4 +4,46 @@ if not hasattr(settings, 'WIKI_REPOSITORY_PATH'):
     raise Exception('You must set WIKI_REPOSITORY_PATH in your settings file.')
 
 REPOSITORY_PATH = settings.WIKI_REPOSITORY_PATH
+
+# Don't keep a working copy of the repository, which nothing reads.
+REPOSITORY_BARE = getattr(settings, 'WIKI_REPOSITORY_BARE', False)
 GALLERY_URL = settings.MEDIA_URL + 'images/'
+
+# Caches of data derived from document revisions ('rendered' documents,
+# 'diff' tables), see wiki.cache.
+# Maps cache names to dicts with optional keys: SIZE - memory budget
+# in bytes (0 disables the in-memory tier) and BACKEND - URI of
+# a Django cache backend to use as a second tier.
+CACHES = getattr(settings, 'WIKI_CACHES', {})
+
+# Compression level (1-9) of gzipped responses.
+GZIP_LEVEL = getattr(settings, 'WIKI_GZIP_LEVEL', 6)
+
+# Uploaded ZIP files wait here to be imported by the importworker command.
+# By default, they're kept in the repository's cache directory.
+IMPORT_SPOOL_PATH = getattr(settings, 'WIKI_IMPORT_SPOOL_PATH', None)
+
+# Seconds after which a running import job with no progress is taken
+# for abandoned by its worker and queued again.
+IMPORT_JOB_TIMEOUT = getattr(settings, 'WIKI_IMPORT_JOB_TIMEOUT', 60 * 60)
+
+# Number of documents committed together by an import job.
+IMPORT_BATCH_SIZE = getattr(settings, 'WIKI_IMPORT_BATCH_SIZE', 50)
+
+# SQLite database of the full-text search index, see wiki.search.
+# By default, it's kept in the repository's cache directory.
+SEARCH_INDEX_PATH = getattr(settings, 'WIKI_SEARCH_INDEX_PATH', None)
+
+# Filebrowser version of images used as gallery thumbnails.
+GALLERY_THUMBNAIL_VERSION = getattr(settings, 'WIKI_GALLERY_THUMBNAIL_VERSION', 'thumbnail')
+
+# Filebrowser versions of gallery images made when they're uploaded,
+# see wiki.scans.
+GALLERY_VERSIONS = getattr(settings, 'WIKI_GALLERY_VERSIONS', ('thumbnail', 'big'))
+
+# Size (in pixels) of Deep Zoom tiles of gallery images.
+GALLERY_TILE_SIZE = getattr(settings, 'WIKI_GALLERY_TILE_SIZE', 256)
+
+# Number of processes making tiles of uploaded images in the background.
+# With 0, they're made during the upload.
+GALLERY_RENDER_PROCESSES = getattr(settings, 'WIKI_GALLERY_RENDER_PROCESSES', 2)
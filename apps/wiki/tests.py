@@ -3,6 +3,7 @@ from django.contrib.auth.models import User, Permission
 
 from wiki import settings
 import wiki.models as models
+import os
 import shutil
 import tempfile
 
@@ -27,6 +28,9 @@ class TestDocumentStorage(TestStorageBase):
     def test_storage_empty(self):
         self.assertEqual(self.storage.all(), [])
 
+    def test_storage_shared(self):
+        self.assertTrue(models.getstorage() is self.storage)
+
     def test_get_text(self):
         self.storage.create_document(u"This is a test document.", u"TEST")
         response = self.client.get("/documents/TEST/text")
@@ -35,6 +39,23 @@ class TestDocumentStorage(TestStorageBase):
         self.assertEqual(result["text"], "This is a test document.")
         self.assertEqual(result["revision"], 0)
 
+    def test_text_etag(self):
+        self.storage.create_document(u"V1", u"TEST")
+        response = self.client.get("/documents/TEST/text")
+        etag = response["ETag"]
+
+        response = self.client.get("/documents/TEST/text", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.storage.put(models.Document(self.storage, name=u"TEST", text=u"V2"),
+                author=u"Tester", comment=u"Change")
+        response = self.client.get("/documents/TEST/text", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)["text"], u"V2")
+
+        response = self.client.get("/documents/TEST/text", {"revision": 0}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
     def test_change_text(self):
         self.storage.create_document(u"V1", u"TEST")
 
@@ -51,6 +72,364 @@ class TestDocumentStorage(TestStorageBase):
         result = json.loads(response.content)
         self.assertEqual(result["text"], u"V2")
         self.assertEqual(result["revision"], 1)
+        self.assertEqual(result["merged"], False)
+
+        # someone else saved in the meantime
+        response = self.client.post("/documents/TEST/text", {
+            "textsave-id": "TEST",
+            "textsave-parent_revision": 0,
+            "textsave-text": u"V1\nV3",
+            "textsave-author_name": u"Tester",
+            "textsave-author_email": u"tester@example.com",
+            "textsave-comment": u"Another version"
+        })
+        result = json.loads(response.content)
+        self.assertEqual(result["merged"], True)
+        self.assertEqual(result["revision"], self.storage.current_revision(u"TEST"))
+        self.assertEqual(result["text"], self.storage.get(u"TEST").plain_text)
+
+    def test_rendered_cache(self):
+        self.storage.create_document(u"<!-- gallery: scans\n-->Text", u"TEST")
+        document = self.storage.get(u"TEST")
+        self.assertEqual(document.plain_text, u"Text")
+        self.assertEqual(document.meta()["gallery"], u"scans")
+        self.assertTrue(self.storage.get(u"TEST").rendered() is document.rendered())
+
+        document.text = u"Changed"
+        self.assertEqual(document.plain_text, u"Changed")
+        self.assertEqual(self.storage.get(u"TEST").plain_text, u"Text")
+
+    def test_history_window(self):
+        self.storage.create_document(u"V1", u"TEST")
+        for n in range(2, 5):
+            self.storage.put(models.Document(self.storage, name=u"TEST", text=u"V%d" % n),
+                    author=u"Tester", comment=u"Version %d" % n)
+
+        response = self.client.get("/documents/TEST/history", {"from": 1, "limit": 2})
+        self.assertEqual(response.status_code, 200, "Request failed with code %r" % response.status_code)
+        result = json.loads(response.content)
+        self.assertEqual([entry["version"] for entry in result], [2, 1])
+        self.assertEqual(result[0]["description"], u"Version 3")
+
+        for limit in ("0", "-1", "x"):
+            response = self.client.get("/documents/TEST/history", {"limit": limit})
+            self.assertEqual(response.status_code, 400)
+
+    def test_gzipped_responses(self):
+        import gzip, StringIO
+        self.storage.create_document(u"V1", u"TEST")
+
+        def ungzip(response):
+            self.assertEqual(response["Content-Encoding"], "gzip")
+            return json.loads(gzip.GzipFile(fileobj=StringIO.StringIO(response.content)).read())
+
+        for n in range(2):  # compressed and then cached
+            response = self.client.get("/documents/TEST/text", HTTP_ACCEPT_ENCODING="gzip")
+            self.assertEqual(ungzip(response)["text"], u"V1")
+
+        response = self.client.get("/documents/TEST/history", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual([entry["version"] for entry in ungzip(response)], [0])
+
+    def test_diff_cache(self):
+        self.storage.create_document(u"V1", u"TEST")
+        response = self.client.post("/documents/TEST/text", {
+            "textsave-id": "TEST",
+            "textsave-parent_revision": 0,
+            "textsave-text": u"V2",
+            "textsave-author_name": u"Tester",
+            "textsave-author_email": u"tester@example.com",
+            "textsave-comment": u"New version"
+        })
+        self.assertEqual(response.status_code, 200, "Request failed with code %r" % response.status_code)
+        # the diff is prepared in the background
+        models._diff_queue.join()
+        key = (self.storage.path, u"TEST", 0, 1)
+        table = models._diff_cache.get(key)
+        self.assertTrue(u"V2" in table[0])
+
+        response = self.client.get("/documents/TEST/diff", {"from": 1, "to": 0})
+        self.assertEqual(response["X-Diff-Hunks"], "1")
+        self.assertTrue(table[0].encode('utf-8') in response.content)
+
+        response = self.client.get("/documents/TEST/diff", {"from": 0, "to": 5})
+        self.assertEqual(response.status_code, 404)
+
+    def test_diff_window(self):
+        lines = [u"Line %d" % n for n in range(100)]
+        self.storage.create_document(u"\n".join(lines), u"TEST")
+        for n in range(0, 100, 10):
+            lines[n] = u"Changed %d" % n
+        self.storage.put(models.Document(self.storage, name=u"TEST", text=u"\n".join(lines)),
+                author=u"Tester", comment=u"Change")
+
+        response = self.client.get("/documents/TEST/diff",
+                {"from": 0, "to": 1, "hunk_from": 2, "hunk_limit": 3})
+        self.assertEqual(response.status_code, 200, "Request failed with code %r" % response.status_code)
+        self.assertEqual(response["X-Diff-Hunks"], "10")
+        self.assertTrue('data-hunk-count="10"' in response.content)
+        self.assertEqual([n for n in range(0, 100, 10) if "Changed %d<" % n in response.content],
+                [20, 30, 40])
+
+        for hunk_limit in ("0", "-1", "x"):
+            response = self.client.get("/documents/TEST/diff", {"from": 0, "to": 1, "hunk_limit": hunk_limit})
+            self.assertEqual(response.status_code, 400)
+        response = self.client.get("/documents/TEST/diff", {"from": 0, "to": 1, "hunk_from": -2})
+        self.assertEqual(response.status_code, 400)
+
+    def test_changes(self):
+        self.storage.create_document(u"A", u"A")
+        self.storage.create_document(u"B", u"B")
+        self.storage.delete(u"A", u"Tester", u"Deleted")
+
+        response = self.client.get("/documents/changes/", {"since": 0, "limit": 1})
+        self.assertEqual(json.loads(response.content), {
+            "changes": [{"name": "B", "deleted": False}],
+            "cursor": 1,
+            "more": True,
+        })
+
+        response = self.client.get("/documents/changes/", {"since": 1})
+        self.assertEqual(json.loads(response.content), {
+            "changes": [{"name": "A", "deleted": True}],
+            "cursor": 2,
+            "more": False,
+        })
+
+        for limit in ("0", "-1", "x"):
+            response = self.client.get("/documents/changes/", {"since": 0, "limit": limit})
+            self.assertEqual(response.status_code, 400)
+
+    def test_global_history(self):
+        self.storage.create_document(u"A", u"A")
+        self.storage.put(models.Document(self.storage, name=u"B", text=u"B"),
+                author=u"Tester", comment=u"B\n#stage-finished: first_correction\n")
+
+        response = self.client.get("/documents/history/", {"limit": 1})
+        result = json.loads(response.content)
+        self.assertEqual(result["cursor"], 1)
+        self.assertEqual(result["changesets"][0]["pages"], [u"B"])
+        self.assertFalse("#stage-finished" in result["changesets"][0]["description"])
+
+        response = self.client.get("/documents/history/", {"cursor": 1, "author": "wiki"})
+        result = json.loads(response.content)
+        self.assertEqual([entry["pages"] for entry in result["changesets"]], [[u"A"]])
+
+        response = self.client.get("/documents/history/", {"since": "yesterday"})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get("/documents/history/", {"limit": 0})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get("/documents/history/", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        import gzip, StringIO
+        result = json.loads(gzip.GzipFile(fileobj=StringIO.StringIO(response.content)).read())
+        self.assertEqual(len(result["changesets"]), 2)
+
+    def test_document_list(self):
+        for name in (u"mickiewicz__dziady", u"mickiewicz__pan_tadeusz", u"slowacki__kordian"):
+            self.storage.create_document(u"Text", name)
+
+        response = self.client.get("/documents/catalogue/")
+        self.assertEqual([doc.name for doc in response.context["docs"]],
+                [u"mickiewicz__dziady", u"mickiewicz__pan_tadeusz", u"slowacki__kordian"])
+
+        self.storage.put(models.Document(self.storage, name=u"slowacki__kordian", text=u"New"),
+                author=u"Tester", comment=u"Done\n#stage-finished: tagging\n")
+        self.storage.delete(u"mickiewicz__dziady", u"Tester", u"Deleted")
+        response = self.client.get("/documents/catalogue/")
+        self.assertEqual([(doc.name, doc.stage) for doc in response.context["docs"]],
+                [(u"mickiewicz__pan_tadeusz", u""), (u"slowacki__kordian", u"tagging")])
+
+        response = self.client.get("/documents/catalogue/slowacki/")
+        self.assertEqual([doc.name for doc in response.context["docs"]], [u"slowacki__kordian"])
+
+        response = self.client.get("/documents/catalogue/", {"filter": u"tadeusz"})
+        self.assertEqual([doc.name for doc in response.context["docs"]], [u"mickiewicz__pan_tadeusz"])
+
+        # changesets without pages are only read once
+        doc = self.storage.get(u"slowacki__kordian")
+        doc.add_tag(u"ready_to_publish", doc.revision, u"Tester")
+        response = self.client.get("/documents/catalogue/")
+        tip = self.storage.vstorage.repo_revision()
+        self.assertTrue(max(doc.changeset for doc in response.context["docs"]) < tip)
+        self.assertEqual(models.CatalogueState.objects.get().revision, tip)
+
+    def test_document_list_concurrent(self):
+        from wiki import catalogue
+        self.storage.create_document(u"Text", u"a")
+        catalogue.refresh(self.storage)
+
+        # another process commits and refreshes the catalogue
+        other = models.DocumentStorage(settings.REPOSITORY_PATH)
+        other.create_document(u"Text", u"b")
+        catalogue.refresh(other)
+        models.CatalogueEntry.objects.filter(name=u"a").update(title=u"Kept")
+
+        catalogue.refresh(self.storage)
+        self.assertEqual([(entry.name, entry.title) for entry in catalogue.entries()],
+                [(u"a", u"Kept"), (u"b", u"B")])
+
+        # rewritten history is noticed
+        models.CatalogueState.objects.update(node="x")
+        catalogue.refresh(self.storage)
+        self.assertEqual([entry.title for entry in catalogue.entries()], [u"A", u"B"])
+
+    def test_search(self):
+        self.storage.create_document(u"<akap>Litwo! Ojczyzno moja! Ty jesteś jak zdrowie.</akap>", u"pan_tadeusz")
+        self.storage.create_document(u"<akap>Polska zdrowie.</akap>", u"inny")
+
+        response = self.client.get("/documents/search/", {"q": u"ojczyzno JESTES"})
+        result = json.loads(response.content)
+        self.assertEqual([r["name"] for r in result["results"]], [u"pan_tadeusz"])
+        snippet = result["results"][0]["snippet"]
+        self.assertEqual([snippet[start:end] for start, end in result["results"][0]["matches"]],
+                [u"Ojczyzno", u"jesteś"])
+
+        response = self.client.get("/documents/search/", {"q": u"zdrowie", "limit": 1})
+        result = json.loads(response.content)
+        self.assertEqual([r["name"] for r in result["results"]], [u"inny"])
+        self.assertEqual(result["next"], 1)
+
+        # the index follows new commits
+        self.storage.put(models.Document(self.storage, name=u"inny", text=u"<akap>Nic</akap>"),
+                author=u"Tester", comment=u"Changed")
+        self.storage.delete(u"pan_tadeusz", u"Tester", u"Deleted")
+        response = self.client.get("/documents/search/", {"q": u"zdrowie"})
+        self.assertEqual(json.loads(response.content)["results"], [])
+        response = self.client.get("/documents/search/", {"q": u'"nic"'})
+        self.assertEqual([r["name"] for r in json.loads(response.content)["results"]], [u"inny"])
+
+        # an index ahead of the repository, or of another history, is rebuilt
+        from wiki import search
+        index = search.SearchIndex(self.storage)
+        original_batch_size, search.BATCH_SIZE = search.BATCH_SIZE, 1
+        try:
+            for change in ("revision = 100", "node = 'x'"):
+                connection = index.connect()
+                connection.execute("UPDATE state SET " + change)
+                connection.close()
+                self.assertEqual([r["name"] for r in index.search(u"nic")], [u"inny"])
+        finally:
+            search.BATCH_SIZE = original_batch_size
+
+        # but not when another process has indexed newer commits
+        other = models.DocumentStorage(settings.REPOSITORY_PATH)
+        other.create_document(u"<akap>Nic nowego</akap>", u"nowy")
+        search.SearchIndex(other).refresh()
+        connection = index.connect()
+        connection.execute("DELETE FROM documents WHERE docid = "
+                           "(SELECT rowid FROM names WHERE name = 'inny')")
+        connection.close()
+        self.assertEqual([r["name"] for r in index.search(u"nic")], [u"nowy"])
+
+        response = self.client.get("/documents/search/", {"q": u"x", "offset": "a"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_themes(self):
+        for name in (u"Żal", u"Zazdrość", u"zamek", u"Miłość"):
+            models.Theme.objects.create(name=name)
+
+        response = self.client.get("/themes", {"q": u"za"})
+        self.assertEqual(response.content.decode('utf-8').split(u"\n"), [u"Żal", u"zamek", u"Zazdrość"])
+        response = self.client.get("/themes", {"q": u"ZA", "limit": 2})
+        self.assertEqual(response.content.decode('utf-8').split(u"\n"), [u"Żal", u"zamek"])
+
+        models.Theme.objects.get(name=u"zamek").delete()
+        models.Theme.objects.create(name=u"Zabawa")
+        response = self.client.get("/themes", {"q": u"zą"})
+        self.assertEqual(response.content.decode('utf-8').split(u"\n"), [u"Zabawa", u"Żal", u"Zazdrość"])
+
+        for limit in ("0", "-1", "x"):
+            response = self.client.get("/themes", {"q": u"za", "limit": limit})
+            self.assertEqual(response.status_code, 400)
+
+    def test_history_not_found(self):
+        response = self.client.get("/documents/MISSING/history")
+        self.assertEqual(response.status_code, 404)
+
+
+class TestUpload(TestStorageBase):
+
+    def setUp(self):
+        super(TestUpload, self).setUp()
+        self.original_spool = settings.IMPORT_SPOOL_PATH
+        settings.IMPORT_SPOOL_PATH = tempfile.mkdtemp(prefix='nosetest_spool_')
+
+    def tearDown(self):
+        shutil.rmtree(settings.IMPORT_SPOOL_PATH)
+        settings.IMPORT_SPOOL_PATH = self.original_spool
+        super(TestUpload, self).tearDown()
+
+    def upload(self, files):
+        import zipfile, StringIO
+        data = StringIO.StringIO()
+        zip = zipfile.ZipFile(data, 'w')
+        for filename, content in files:
+            zip.writestr(filename, content)
+        zip.close()
+        data.seek(0)
+        data.name = 'upload.zip'
+        return self.client.post("/documents/upload/", {"file": data})
+
+    def test_import(self):
+        from wiki import imports
+        response = self.upload([("A.xml", u"Zażółć".encode('utf-8')), ("B.xml", "B"), ("readme.txt", "")])
+        self.assertEqual(response.status_code, 302)
+        job = models.ImportJob.objects.get()
+        self.assertEqual(job.status, models.ImportJob.QUEUED)
+
+        imports.work(once=True)
+        response = self.client.get("/documents/upload/%d/status" % job.pk)
+        self.assertEqual(json.loads(response.content),
+                {"status": "done", "total": 2, "processed": 2})
+        self.assertEqual(sorted(self.storage.all()), [u"A", u"B"])
+        self.assertEqual(self.storage.get(u"A").text, u"Zażółć")
+        self.assertEqual(os.listdir(settings.IMPORT_SPOOL_PATH), [])
+
+        response = self.client.get("/documents/upload/%d/" % job.pk)
+        self.assertEqual(response.context["skipped_list"], ["readme.txt"])
+
+    def test_import_errors(self):
+        from wiki import imports
+        self.storage.create_document(u"Text", u"B")
+        self.upload([("A.xml", "A"), ("B.xml", "B"), ("C.xml", u"Zażółć".encode('latin2'))])
+        imports.work(once=True)
+
+        job = models.ImportJob.objects.get()
+        self.assertEqual(job.status, models.ImportJob.DONE)
+        self.assertEqual([title for filename, title, error in json.loads(job.result)["error_list"]],
+                [u"B", u"C"])
+        self.assertEqual(self.storage.all(), [u"B"])
+
+    def test_stale_job(self):
+        from datetime import datetime, timedelta
+        from wiki import imports
+        self.upload([("A.xml", "A"), ("B.xml", "B")])
+        job = imports.claim_job("crashed")
+
+        # the worker committed the first batch and died
+        self.storage.create_document(u"A", u"A")
+        models.ImportJob.objects.filter(pk=job.pk).update(
+                updated_at=datetime.now() - timedelta(seconds=settings.IMPORT_JOB_TIMEOUT + 1),
+                total=2, processed=1, result=json.dumps({"ok_list": [["A.xml", "A"], ["B.xml", "B"]]}))
+
+        imports.work(once=True)
+        job = models.ImportJob.objects.get()
+        self.assertEqual((job.status, job.processed), (models.ImportJob.DONE, 2))
+        self.assertEqual(json.loads(job.result)["error_list"], [])
+        self.assertEqual(sorted(self.storage.all()), [u"A", u"B"])
+
+    def test_lost_job(self):
+        from wiki import imports
+        self.upload([("A.xml", "A")])
+        job = imports.claim_job("slow")
+
+        # queued again and taken by another worker, while the first one is running
+        models.ImportJob.objects.filter(pk=job.pk).update(worker="other")
+        imports.run_job(job)
+        self.assertEqual(models.ImportJob.objects.get().status, models.ImportJob.RUNNING)
+        self.assertEqual(self.storage.all(), [])
+        self.assertTrue(os.path.exists(job.file_path))
 
 
 class TestTextRevert(TestStorageBase):
@@ -116,3 +495,122 @@ class TestTextRevert(TestStorageBase):
 
         # revert produces a new commit
         self.assertEqual(result["revision"], 4)
+
+
+class TestDiff(TestCase):
+
+    def test_same_changes_as_difflib(self):
+        import difflib
+        from wiki import nice_diff
+        la = [u"line %d" % n for n in range(40)]
+        lb = la[:5] + [u"line five", u"new line"] + la[7:30] + la[31:] + [u"last line"]
+        self.assertEqual(list(nice_diff.diff_changes(la, lb)), list(difflib._mdiff(la, lb)))
+
+    def test_patience_alignment(self):
+        import difflib
+        from wiki import nice_diff
+        # SequenceMatcher matches the first closing tag with the inserted one
+        la = [u"<akap>", u"</akap>", u"<strofa>", u"</akap>"]
+        lb = [u"<akap>", u"</akap>", u"<motto>", u"</akap>", u"<strofa>", u"</akap>"]
+        self.assertEqual(difflib.SequenceMatcher(None, la, lb).get_opcodes(),
+                [('equal', 0, 1, 0, 1), ('insert', 1, 1, 1, 3), ('equal', 1, 4, 3, 6)])
+        self.assertEqual(nice_diff.line_opcodes(la, lb),
+                [('equal', 0, 2, 0, 2), ('insert', 2, 2, 2, 4), ('equal', 2, 4, 4, 6)])
+        self.assertEqual([(a[0], b[0], change) for a, b, change in nice_diff.diff_changes(la, lb)],
+                [(1, 1, False), (2, 2, False), ('', 3, True), ('', 4, True), (3, 5, False), (4, 6, False)])
+
+    def test_intraline_limit(self):
+        from wiki import nice_diff
+        la = [u"line %d" % n for n in range(10)]
+        lb = [u"line %d!" % n for n in range(8)]
+        changes = list(nice_diff.diff_changes(la, lb, intraline_limit=5))
+        self.assertEqual(changes[0], ((1, u"\0-line 0\1"), (1, u"\0+line 0!\1"), True))
+        self.assertEqual(changes[-1], ((10, u"\0-line 9\1"), ('', '\n'), True))
+
+    def test_html_table(self):
+        from wiki import nice_diff
+        html = nice_diff.html_diff_table([u"a", u"<b>"], [u"a", u"<c>"], context=3)
+        self.assertTrue(u'<td class="left">\0' not in html)
+        self.assertTrue(u'<span class="diff_mark diff_mark_removed">&lt;b&gt;</span>' in html, html)
+
+
+class TestGallery(TestCase):
+
+    def setUp(self):
+        from django.conf import settings as django_settings
+        self.django_settings = django_settings
+        self.original_media_root = django_settings.MEDIA_ROOT
+        django_settings.MEDIA_ROOT = tempfile.mkdtemp(prefix='nosetest_media_')
+        self.gallery_dir = os.path.join(django_settings.MEDIA_ROOT,
+                                        django_settings.FILEBROWSER_DIRECTORY, 'scans')
+        os.makedirs(self.gallery_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.django_settings.MEDIA_ROOT)
+        self.django_settings.MEDIA_ROOT = self.original_media_root
+
+    def add_image(self, filename, size):
+        from PIL import Image
+        Image.new('RGB', size).save(os.path.join(self.gallery_dir, filename))
+        # make sure the change is noticed despite mtime resolution
+        stat = os.stat(self.gallery_dir)
+        os.utime(self.gallery_dir, (stat.st_atime, stat.st_mtime + 1))
+
+    def test_gallery(self):
+        self.add_image('002.png', (20, 30))
+        self.add_image('001.jpg', (10, 15))
+        open(os.path.join(self.gallery_dir, 'readme.txt'), 'w').close()
+
+        response = self.client.get("/documents/scans/gallery")
+        result = json.loads(response.content)
+        self.assertEqual(result["total"], 2)
+        self.assertEqual([(image["url"].rsplit('/', 1)[1], image["width"], image["height"])
+                          for image in result["images"]],
+                         [(u"001.jpg", 10, 15), (u"002.png", 20, 30)])
+        self.assertEqual(result["images"][0]["thumbnail"], None)
+
+        self.add_image('003.png', (5, 5))
+        response = self.client.get("/documents/scans/gallery", {"offset": 1, "limit": 1})
+        result = json.loads(response.content)
+        self.assertEqual(result["total"], 3)
+        self.assertEqual([image["url"].rsplit('/', 1)[1] for image in result["images"]], [u"002.png"])
+
+        for params in ({"limit": "0"}, {"limit": "x"}, {"offset": "-1"}):
+            response = self.client.get("/documents/scans/gallery", params)
+            self.assertEqual(response.status_code, 400)
+
+    def test_renditions(self):
+        import filebrowser.functions, filebrowser.versioning
+        from filebrowser.base import FileObject
+        from filebrowser.views import filebrowser_post_upload
+        from wiki import scans
+
+        originals = (filebrowser.functions.MEDIA_ROOT, filebrowser.versioning.MEDIA_ROOT, scans.MEDIA_ROOT,
+                     filebrowser.versioning.VERSION_PROCESSES, settings.GALLERY_RENDER_PROCESSES)
+        filebrowser.functions.MEDIA_ROOT = filebrowser.versioning.MEDIA_ROOT = scans.MEDIA_ROOT = \
+            self.django_settings.MEDIA_ROOT
+        filebrowser.versioning.VERSION_PROCESSES = settings.GALLERY_RENDER_PROCESSES = 0
+        try:
+            self.add_image('001.png', (700, 1000))
+            filebrowser_post_upload.send(sender=None, path='scans',
+                file=FileObject(os.path.join(self.django_settings.FILEBROWSER_DIRECTORY, 'scans', '001.png')))
+        finally:
+            (filebrowser.functions.MEDIA_ROOT, filebrowser.versioning.MEDIA_ROOT, scans.MEDIA_ROOT,
+             filebrowser.versioning.VERSION_PROCESSES, settings.GALLERY_RENDER_PROCESSES) = originals
+
+        response = self.client.get("/documents/scans/gallery")
+        image = json.loads(response.content)["images"][0]
+        self.assertEqual([(version["version"], version["width"], version["height"]) for version in image["versions"]],
+                         [(u"thumbnail", 140, 200), (u"big", 620, 885)])
+        self.assertTrue(image["thumbnail"].endswith(u"/scans/001_thumbnail.png"))
+        self.assertTrue(image["tiles"]["url"].endswith(u"/scans/001.dzi"))
+        self.assertEqual(image["tiles"]["levels"], 11)
+
+        tiles_path = scans.pyramid_path(os.path.join(self.django_settings.FILEBROWSER_DIRECTORY, 'scans', '001.png'))[1]
+        tiles_dir = os.path.join(self.django_settings.MEDIA_ROOT, tiles_path)
+        self.assertEqual(len(os.listdir(os.path.join(tiles_dir, '10'))), 3 * 4)
+        self.assertEqual(os.listdir(os.path.join(tiles_dir, '0')), ['0_0.jpg'])
+
+    def test_missing_gallery(self):
+        response = self.client.get("/documents/missing/gallery")
+        self.assertEqual(response.status_code, 404)
@@ -14,6 +14,10 @@ urlpatterns = patterns('wiki.views',
     url(r'^catalogue/([^/]+)/([^/]+)/$', 'document_list'),
     url(r'^catalogue/([^/]+)/([^/]+)/([^/]+)$', 'document_list'),
 
+    url(r'^changes/$', 'changes', name='wiki_changes'),
+    url(r'^history/$', 'global_history', name='wiki_global_history'),
+    url(r'^search/$', 'search', name='wiki_search'),
+
     url(r'^(?P<name>%s)$' % PART,
         'editor', name="wiki_editor"),
 
@@ -23,6 +27,12 @@ urlpatterns = patterns('wiki.views',
     url(r'^upload/$',
         'upload', name='wiki_upload'),
 
+    url(r'^upload/(?P<job_id>\d+)/$',
+        'upload_job', name='wiki_upload_job'),
+
+    url(r'^upload/(?P<job_id>\d+)/status$',
+        'upload_job_status', name='wiki_upload_job_status'),
+
     url(r'^create/(?P<name>[^/]+)',
         'create_missing', name='wiki_create_missing'),
 
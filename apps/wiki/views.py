@@ -1,36 +1,60 @@
-import os
 import functools
+import itertools
 import logging
 logger = logging.getLogger("fnp.wiki")
 
 from django.conf import settings
 
 from django.views.generic.simple import direct_to_template
-from django.views.decorators.http import require_POST, require_GET
+from django.views.decorators.http import require_POST, require_GET, condition
 from django.core.urlresolvers import reverse
 from wiki.helpers import (JSONResponse, JSONFormInvalid, JSONServerError,
+                GzippedResponse, accepts_gzip, json_response,
                 ajax_require_permission, recursive_groupby)
 from django import http
+from django.shortcuts import get_object_or_404
+from django.core.paginator import Paginator, InvalidPage
 
-from wiki.models import getstorage, DocumentNotFound, normalize_name, split_name, join_name, Theme
+from wiki.models import getstorage, DocumentNotFound, normalize_name, split_name, join_name, ImportJob, theme_index
 from wiki.forms import DocumentTextSaveForm, DocumentTagForm, DocumentCreateForm, DocumentsUploadForm
 from datetime import datetime
-from django.utils.encoding import smart_unicode
+from django.utils import simplejson as json
+from django.utils.http import urlquote
 from django.utils.translation import ugettext_lazy as _
 from django.utils.decorators import decorator_from_middleware
 from django.middleware.gzip import GZipMiddleware
 
 
 #
-# Quick hack around caching problems, TODO: use ETags
+# Document views send ETags derived from document revisions; never_cache
+# makes browsers revalidate them every time instead of guessing freshness.
 #
 from django.views.decorators.cache import never_cache
 
 import wlapi
+from wiki import imports, catalogue
+from wiki.search import SearchIndex
+from wiki.gallery import gallery_stamp, list_images
 import nice_diff
 import operator
 
 MAX_LAST_DOCS = 10
+CATALOGUE_PAGE_SIZE = 100
+MAX_SEARCH_RESULTS = 100
+
+
+def get_limit(request, param='limit', default=None):
+    """
+    Read a positive integer parameter of a GET request, or return
+    `default` if it's not given. Raises ValueError for other values.
+    """
+    value = request.GET.get(param)
+    if not value:
+        return default
+    value = int(value)
+    if value < 1:
+        raise ValueError("%s must be positive" % param)
+    return value
 
 
 def normalized_name(view):
@@ -50,9 +74,20 @@ def normalized_name(view):
 
 
 @never_cache
-def document_list(request):
+def document_list(request, *parts):
+    catalogue.refresh(getstorage())
+
+    query = normalize_name(request.GET.get('filter', u''))
+    paginator = Paginator(catalogue.entries(parts, query), CATALOGUE_PAGE_SIZE)
+    try:
+        page = paginator.page(int(request.GET.get('page', 1)))
+    except (ValueError, InvalidPage):
+        raise http.Http404
+
     return direct_to_template(request, 'wiki/document_list.html', extra_context={
-        'docs': getstorage().all(),
+        'docs': page.object_list,
+        'page': page,
+        'filter': query,
         'last_docs': sorted(request.session.get("wiki_last_docs", {}).items(),
                         key=operator.itemgetter(1), reverse=True),
     })
@@ -146,48 +181,11 @@ def create_missing(request, name):
 
 
 def upload(request):
-    storage = getstorage()
-
     if request.method == "POST":
         form = DocumentsUploadForm(request.POST, request.FILES)
         if form.is_valid():
-            zip = form.cleaned_data['zip']
-            skipped_list = []
-            ok_list = []
-            error_list = []
-            titles = {}
-            existing = storage.all()
-            for filename in zip.namelist():
-                if filename[-1] == '/':
-                    continue
-                title = normalize_name(os.path.basename(filename)[:-4])
-                if not (title and filename.endswith('.xml')):
-                    skipped_list.append(filename)
-                elif title in titles:
-                    error_list.append((filename, title, _('Title already used for %s' % titles[title])))
-                elif title in existing:
-                    error_list.append((filename, title, _('Title already used in repository.')))
-                else:
-                    try:
-                        zip.read(filename).decode('utf-8') # test read
-                        ok_list.append((filename, title))
-                    except UnicodeDecodeError:
-                        error_list.append((filename, title, _('File should be UTF-8 encoded.')))
-                    titles[title] = filename
-
-            if not error_list:
-                for filename, title in ok_list:
-                    storage.create_document(
-                        name=title,
-                        text=zip.read(filename).decode('utf-8')
-                    )
-
-            return direct_to_template(request, "wiki/document_upload.html", extra_context={
-                "form": form,
-                "ok_list": ok_list,
-                "skipped_list": skipped_list,
-                "error_list": error_list,
-            })
+            job = imports.enqueue(form.cleaned_data['file'])
+            return http.HttpResponseRedirect(reverse("wiki_upload_job", args=[job.pk]))
     else:
         form = DocumentsUploadForm()
 
@@ -196,8 +194,47 @@ def upload(request):
     })
 
 
+@never_cache
+def upload_job(request, job_id):
+    job = get_object_or_404(ImportJob, pk=job_id)
+    result = job.result and json.loads(job.result) or {}
+    return direct_to_template(request, "wiki/document_upload.html", extra_context={
+        "form": DocumentsUploadForm(),
+        "job": job,
+        "job_error": result.get("error"),
+        "ok_list": result.get("ok_list", []),
+        "skipped_list": result.get("skipped_list", []),
+        "error_list": result.get("error_list", []),
+    })
+
+
+@never_cache
+def upload_job_status(request, job_id):
+    job = get_object_or_404(ImportJob, pk=job_id)
+    return JSONResponse({
+        "status": job.status,
+        "total": job.total,
+        "processed": job.processed,
+    })
+
+
+def text_etag(request, name):
+    if request.method != 'GET':
+        return None
+
+    try:
+        revision = request.GET.get('revision')
+        if revision is None:
+            revision = getstorage().current_revision(name)
+        return "text/%s/%d" % (urlquote(name), int(revision))
+    except (ValueError, DocumentNotFound):
+        # tags and missing documents
+        return None
+
+
 @never_cache
 @normalized_name
+@condition(etag_func=text_etag)
 @decorator_from_middleware(GZipMiddleware)
 def text(request, name):
     storage = getstorage()
@@ -218,12 +255,17 @@ def text(request, name):
                 author_name = form.cleaned_data['author_name']
                 author_email = form.cleaned_data['author_email']
             author = "%s <%s>" % (author_name, author_email)
-            storage.put(document, author=author, comment=comment, parent=revision)
-            document = storage.get(name)
+            saved_revision, merged = storage.put(document, author=author, comment=comment, parent=revision)
+            # not the tip, which may be someone else's change by now
+            document = storage.get(name, saved_revision)
+            if saved_revision > 0 and revision != saved_revision:
+                # reviewers are going to look at this change next
+                storage.prepare_diff(name, saved_revision - 1, saved_revision)
             return JSONResponse({
-                'text': document.plain_text if revision != document.revision else None,
+                'text': document.plain_text if revision != saved_revision else None,
                 'meta': document.meta(),
                 'revision': document.revision,
+                'merged': merged,
             })
         else:
             return JSONFormInvalid(form)
@@ -242,11 +284,9 @@ def text(request, name):
         except DocumentNotFound:
             raise http.Http404
 
-        return JSONResponse({
-            'text': document.plain_text,
-            'meta': document.meta(),
-            'revision': document.revision,
-        })
+        if accepts_gzip(request):
+            return GzippedResponse(document.gzipped_json(), mimetype="application/json")
+        return http.HttpResponse(document.rendered()['json'], mimetype="application/json")
 
 
 @never_cache
@@ -270,63 +310,202 @@ def revert(request, name):
     except DocumentNotFound:
         raise http.Http404
 
+def gallery_etag(request, directory):
+    try:
+        stamp = gallery_stamp(directory)
+    except OSError:
+        return None
+    return "gallery/%s/%r/%s/%s" % (urlquote(directory), stamp,
+                urlquote(request.GET.get('offset', '')), urlquote(request.GET.get('limit', '')))
+
+
 @never_cache
+@condition(etag_func=gallery_etag)
 def gallery(request, directory):
+    """
+    Images of a gallery, with their dimensions and thumbnails: at most
+    `limit` of them from `offset`, and the number of all images.
+    """
+    try:
+        offset = int(request.GET.get('offset', 0))
+        limit = get_limit(request)
+    except ValueError:
+        return http.HttpResponseBadRequest()
+    if offset < 0:
+        return http.HttpResponseBadRequest()
+
     try:
-        base_url = ''.join((
-                        smart_unicode(settings.MEDIA_URL),
-                        smart_unicode(settings.FILEBROWSER_DIRECTORY),
-                        smart_unicode(directory)))
-
-        base_dir = os.path.join(
-                    smart_unicode(settings.MEDIA_ROOT),
-                    smart_unicode(settings.FILEBROWSER_DIRECTORY),
-                    smart_unicode(directory))
-
-        def map_to_url(filename):
-            return "%s/%s" % (base_url, smart_unicode(filename))
-
-        def is_image(filename):
-            return os.path.splitext(f)[1].lower() in (u'.jpg', u'.jpeg', u'.png')
-
-        images = [map_to_url(f) for f in map(smart_unicode, os.listdir(base_dir)) if is_image(f)]
-        images.sort()
-        return JSONResponse(images)
-    except (IndexError, OSError):
+        images = list_images(directory)
+    except OSError:
         logger.exception("Unable to fetch gallery")
         raise http.Http404
 
+    end = limit is not None and offset + limit or None
+    return JSONResponse({"images": images[offset:end], "total": len(images)})
+
+
+def diff_etag(request, name):
+    try:
+        revA = int(request.GET.get('from', 0))
+        revB = int(request.GET.get('to', 0))
+        if revA > revB:
+            revA, revB = revB, revA
+        if revB == 0:
+            revB = getstorage().current_revision(name)
+    except (ValueError, DocumentNotFound):
+        return None
+    return "diff/%s/%d/%d/%s/%s" % (urlquote(name), revA, revB,
+                urlquote(request.GET.get('hunk_from', '')), urlquote(request.GET.get('hunk_limit', '')))
+
 
 @never_cache
 @normalized_name
+@condition(etag_func=diff_etag)
 def diff(request, name):
     storage = getstorage()
 
-    revA = int(request.GET.get('from', 0))
-    revB = int(request.GET.get('to', 0))
+    try:
+        revA = int(request.GET.get('from', 0))
+        revB = int(request.GET.get('to', 0))
+        hunk_from = int(request.GET.get('hunk_from', 0))
+        hunk_limit = get_limit(request, 'hunk_limit')
+    except ValueError:
+        return http.HttpResponseBadRequest()
+    if hunk_from < 0:
+        return http.HttpResponseBadRequest()
 
     if revA > revB:
         revA, revB = revB, revA
 
-    if revB == 0:
-        revB = None
+    try:
+        if revB == 0:
+            revB = storage.current_revision(name)
+        hunks = storage.diff(name, revA, revB)
+    except DocumentNotFound:
+        raise http.Http404
+
+    if hunk_limit is None:
+        window = hunks[hunk_from:]
+    else:
+        window = hunks[hunk_from:hunk_from + hunk_limit]
+    response = http.HttpResponse(nice_diff.render_table(window, hunk_from, len(hunks)))
+    response['X-Diff-Hunks'] = str(len(hunks))
+    return response
 
-    docA = storage.get_or_404(name, int(revA))
-    docB = storage.get_or_404(name, int(revB))
 
-    return http.HttpResponse(nice_diff.html_diff_table(docA.plain_text.splitlines(),
-                                         docB.plain_text.splitlines(), context=3))
+def history_etag(request, name):
+    return "history/%s/%d/%s/%s" % (urlquote(name), getstorage().vstorage.repo_revision(),
+                urlquote(request.GET.get('from', '')), urlquote(request.GET.get('limit', '')))
 
 
 @never_cache
 @normalized_name
+@condition(etag_func=history_etag)
 def history(request, name):
     storage = getstorage()
 
-    # TODO: pagination
-    changesets = list(storage.history(name))
+    try:
+        offset = int(request.GET.get('from', 0))
+        limit = get_limit(request)
+    except ValueError:
+        return http.HttpResponseBadRequest()
+
+    changesets = storage.history(name, offset, limit)
+    try:
+        # fail early for missing documents, before the response is streamed
+        first = changesets.next()
+    except DocumentNotFound:
+        raise http.Http404
+    except StopIteration:
+        return JSONResponse([])
+
+    return json_response(request, itertools.chain([first], changesets))
+
+
+@never_cache
+@require_GET
+def changes(request):
+    """
+    Feed of documents changed after repository revision given
+    as `since`: pass the returned `cursor` to get further changes.
+    Without a valid `since`, documents are listed from the first
+    revision on.
+    """
+    vstorage = getstorage().vstorage
+
+    try:
+        limit = get_limit(request)
+    except ValueError:
+        return http.HttpResponseBadRequest()
+
+    names, cursor = vstorage.changed_since(request.GET.get('since'), limit)
+    return JSONResponse({
+        "changes": [{"name": name, "deleted": name not in vstorage} for name in names],
+        "cursor": cursor,
+        "more": cursor < vstorage.repo_revision(),
+    })
+
+
+def global_history_etag(request):
+    return "history/%d/%s" % (getstorage().vstorage.repo_revision(), urlquote(request.GET.urlencode()))
 
-    return JSONResponse(changesets)
+
+@never_cache
+@require_GET
+@condition(etag_func=global_history_etag)
+def global_history(request):
+    """
+    Recent changes of all documents, newest first. Pass the returned
+    `cursor` to get older ones. Can be filtered by `author`, `prefix`
+    of document names and dates: `since` and `until` (exclusive),
+    as YYYY-MM-DD.
+    """
+    params = {}
+    try:
+        if request.GET.get('cursor'):
+            params['cursor'] = int(request.GET['cursor'])
+        params['limit'] = int(request.GET.get('limit', 100))
+        for param in ('since', 'until'):
+            if request.GET.get(param):
+                params[param] = datetime.strptime(request.GET[param], '%Y-%m-%d')
+    except ValueError:
+        return http.HttpResponseBadRequest()
+    if params['limit'] < 1:
+        return http.HttpResponseBadRequest()
+    for param in ('author', 'prefix'):
+        if request.GET.get(param):
+            params[param] = request.GET[param]
+
+    changesets = list(getstorage().global_history(**params))
+    if len(changesets) == params['limit']:
+        cursor = changesets[-1]['revision']
+    else:
+        cursor = None
+    return json_response(request, {"changesets": changesets, "cursor": cursor})
+
+
+@never_cache
+@require_GET
+def search(request):
+    """
+    Find documents containing all words of query `q`, ignoring case
+    and diacritics; "quoted phrases" are matched as a whole. Returns
+    at most `limit` results from `offset`, and the offset of the next
+    ones, if there may be any.
+    """
+    try:
+        offset = int(request.GET.get('offset', 0))
+        limit = min(int(request.GET.get('limit', 20)), MAX_SEARCH_RESULTS)
+    except ValueError:
+        return http.HttpResponseBadRequest()
+    if offset < 0 or limit < 1:
+        return http.HttpResponseBadRequest()
+
+    results = SearchIndex(getstorage()).search(request.GET.get('q', u''), offset, limit)
+    return JSONResponse({
+        "results": results,
+        "next": len(results) == limit and offset + limit or None,
+    })
 
 
 @require_POST
@@ -363,5 +542,10 @@ def publish(request, name):
 
 
 def themes(request):
-    prefix = request.GET.get('q', '')
-    return http.HttpResponse('\n'.join([str(t) for t in Theme.objects.filter(name__istartswith=prefix)]))
+    prefix = request.GET.get('q', u'')
+    try:
+        limit = get_limit(request)
+    except ValueError:
+        return http.HttpResponseBadRequest()
+    return http.HttpResponse(u'\n'.join(theme_index.find(prefix, limit)),
+                             mimetype="text/plain; charset=utf-8")
@@ -4,7 +4,12 @@
 # Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
 #
 import os
-import tempfile
+import sys
+import time
+import errno
+import atexit
+import threading
+import Queue
 import datetime
 import mimetypes
 import urllib
@@ -17,8 +22,11 @@ logger = logging.getLogger('fnp.hazlenut.vstorage')
 os.environ['HGENCODING'] = 'utf-8'
 os.environ['HGMERGE'] = "internal:merge"
 
+import mercurial.context
 import mercurial.hg
+import mercurial.node
 import mercurial.revlog
+import mercurial.simplemerge
 import mercurial.util
 
 from vstorage.hgui import SilentUI
@@ -51,20 +59,6 @@ def find_repo_path(path):
     return path
 
 
-def with_working_copy_locked(func):
-    """A decorator for locking the repository when calling a method."""
-
-    @functools.wraps(func)
-    def wrapped(self, *args, **kwargs):
-        """Wrap the original function in locks."""
-        wlock = self.repo.wlock()
-        try:
-            return func(self, *args, **kwargs)
-        finally:
-            wlock.release()
-    return wrapped
-
-
 def with_storage_locked(func):
     """A decorator for locking the repository when calling a method."""
 
@@ -116,16 +110,21 @@ class VersionedStorage(object):
     change history, using Mercurial repository as the storage method.
     """
 
-    def __init__(self, path, charset=None):
+    def __init__(self, path, charset=None, bare=False):
         """
         Takes the path to the directory where the pages are to be kept.
         If the directory doen't exist, it will be created. If it's inside
         a Mercurial repository, that repository will be used, otherwise
         a new repository will be created in it.
+
+        Pages are only ever read from and written to the repository's
+        revlogs. With `bare` set, the working copy isn't even kept around:
+        its checked out files are removed.
         """
 
         self.charset = charset or 'utf-8'
         self.path = path
+        self.bare = bare
         if not os.path.exists(self.path):
             os.makedirs(self.path)
         self.repo_path = find_repo_path(self.path)
@@ -141,138 +140,401 @@ class VersionedStorage(object):
         self.repo_prefix = self.path[len(self.repo_path):].strip('/')
         self.repo = mercurial.hg.repository(self.ui, self.repo_path,
                                             create=create)
+        self._changelog_stamp = self._read_changelog_stamp()
+        self._index = None
+        self._tags = None
+        self._history = None
+
+        if bare:
+            self._remove_working_copy()
+
+    def _remove_working_copy(self):
+        """Update the working copy to the null revision, removing all files."""
+        if self.repo_prefix:
+            # the working copy isn't only ours
+            return
+        if self.repo.dirstate.parents()[0] == mercurial.node.nullid:
+            return
+        logger.info("Removing working copy of %r", self.repo_path)
+        wlock = self.repo.wlock()
+        try:
+            mercurial.hg.clean(self.repo, mercurial.node.nullid, show_stats=False)
+        finally:
+            wlock.release()
 
     def reopen(self):
         """Close and reopen the repo, to make sure we are up to date."""
         self.repo = mercurial.hg.repository(self.ui, self.repo_path)
+        self._changelog_stamp = self._read_changelog_stamp()
+
+    def _read_changelog_stamp(self):
+        """
+        Return a value that changes every time the changelog is written to:
+        the size, mtime and inode of the changelog's index file.
+        """
+        try:
+            st = os.stat(self.repo.sjoin('00changelog.i'))
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime, st.st_ino
+
+    def refresh(self):
+        """
+        Make sure we see commits made by other processes since the last call.
+
+        This is much cheaper than `reopen`: if the changelog didn't change,
+        nothing is done at all, otherwise only the in-memory caches of the
+        repository (changelog, manifest, tags) are dropped and will be
+        reloaded lazily. Returns True if the caches were dropped.
+        """
+        stamp = self._read_changelog_stamp()
+        if stamp == self._changelog_stamp:
+            return False
+        logger.debug("Changelog of %r changed, invalidating caches", self.repo_path)
+        self._changelog_stamp = stamp
+        self.repo.invalidate()
+        return True
+
+    def _tip_index(self):
+        """
+        Return the index of files present at the repository tip.
+
+        The index is a dict with the tip's node under 'node', a set of all
+        file names under 'files' and results of `all_pages` under 'pages'.
+        It is built once per tip, so that looking up pages doesn't require
+        reading the changelog and manifest every time.
+        """
+        node = self.repo.changelog.tip()
+        if self._index is None or self._index['node'] != node:
+            self._index = {
+                'node': node,
+                'files': frozenset(self.repo[node].manifest()),
+                'pages': {},
+                'filelogs': {},
+            }
+        return self._index
+
+    def _filelog(self, repo_file):
+        """Return the file's revlog. Filelogs are cached until the tip changes."""
+        filelogs = self._tip_index()['filelogs']
+        try:
+            return filelogs[repo_file]
+        except KeyError:
+            filelog = filelogs[repo_file] = self.repo.file(repo_file)
+            return filelog
+
+    HISTORY_INDEX = 'cache/vstorage-history'
+
+    def _history_index(self):
+        """
+        Return a list of (revision, node, timestamp, author, files) tuples
+        for all changesets, oldest first.
+
+        The list is read from an append-only file in .hg/cache, which is
+        extended on every commit (see `_update_history_index`); only the
+        newly appended part of it is read on subsequent calls. Changesets
+        missing from the file are read from the changelog.
+        """
+        changelog = self.repo.changelog
+        cache = self._history
+        if cache is not None:
+            entries = cache['entries']
+            if entries and (len(changelog) < len(entries)
+                    or changelog.node(len(entries) - 1) != entries[-1][1]):
+                # history was stripped
+                cache = None
+        if cache is None:
+            cache = self._history = {'entries': [], 'size': 0, 'indexed': 0, 'broken': False}
+        entries = cache['entries']
+
+        path = self.repo.join(self.HISTORY_INDEX)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+
+        if size > cache['size'] and not cache['broken']:
+            f = open(path, 'rb')
+            try:
+                f.seek(cache['size'])
+                data = f.read(size - cache['size'])
+            finally:
+                f.close()
+
+            for line in data.splitlines(True):
+                if not line.endswith('\n'):
+                    # incomplete last record
+                    cache['broken'] = True
+                    break
+                fields = line[:-1].split('\t')
+                rev, node = int(fields[0]), mercurial.node.bin(fields[1])
+                if rev >= len(changelog):
+                    # committed after we read the changelog
+                    break
+                if rev != cache['indexed'] or changelog.node(rev) != node:
+                    cache['broken'] = True
+                    break
+                if rev == len(entries):
+                    entries.append((rev, node, int(fields[2]), fields[3], tuple(fields[4:])))
+                cache['indexed'] += 1
+                cache['size'] += len(line)
+
+        for rev in xrange(len(entries), len(changelog)):
+            node = changelog.node(rev)
+            _manifest, user, (timestamp, _tz), files, _desc, _extra = changelog.read(node)
+            entries.append((rev, node, int(timestamp), user, tuple(files)))
+
+        return entries
+
+    def _update_history_index(self):
+        """
+        Write changesets missing from the history index file. Must be
+        called with the repository locked, so that writers don't interleave.
+        """
+        entries = self._history_index()
+        cache = self._history
+
+        if cache['broken']:
+            logger.info("Rebuilding history index of %r", self.repo_path)
+            mode, start = 'wb', 0
+        else:
+            mode, start = 'ab', cache['indexed']
+        if start == len(entries):
+            return
+
+        data = ''.join('%d\t%s\t%d\t%s\t%s\n' % (rev, mercurial.node.hex(node), timestamp,
+                            user.replace('\t', ' ').replace('\n', ' '), '\t'.join(files))
+                       for rev, node, timestamp, user, files in entries[start:])
+
+        path = self.repo.join(self.HISTORY_INDEX)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path, mode)
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+        if mode == 'wb':
+            cache['size'] = 0
+        cache['size'] += len(data)
+        cache['indexed'] = len(entries)
+        cache['broken'] = False
+
+    def _tag_index(self):
+        """
+        Return the index of document tags stored in '.hgtags'.
+
+        The index is a dict mapping file names to dicts of tag names and
+        file revisions under 'tags', and file names to dicts of file
+        revisions and lists of tag names under 'revisions'. It's built
+        once from '.hgtags' and only rebuilt when a new version of it
+        is committed by someone else.
+        """
+        hgtags = self._filelog('.hgtags')
+        if self._tags is not None and self._tags['version'] == len(hgtags):
+            return self._tags
+
+        self._tags = {'version': len(hgtags), 'tags': {}, 'revisions': {}}
+        if not len(hgtags):
+            return self._tags
+
+        nodes = {}
+        for line in hgtags.read(hgtags.tip()).splitlines():
+            try:
+                hexnode, name = line.strip().split(' ', 1)
+                node = mercurial.node.bin(hexnode)
+            except (ValueError, TypeError):
+                logger.warning("Malformed line in .hgtags: %r", line)
+                continue
+            if '#' in name:
+                nodes[name] = node  # later lines override earlier ones
+
+        linkrevs = {}
+        changelog = self.repo.changelog
+        for name, node in nodes.iteritems():
+            if node == mercurial.node.nullid:
+                continue  # tag was removed
+            repo_file, tag = name.rsplit('#', 1)
+            try:
+                linkrev = changelog.rev(node)
+                file_linkrevs = linkrevs.get(repo_file)
+                if file_linkrevs is None:
+                    filelog = self._filelog(repo_file)
+                    file_linkrevs = linkrevs[repo_file] = dict(
+                        (filelog.linkrev(filerev), filerev) for filerev in filelog)
+                filerev = file_linkrevs.get(linkrev)
+                if filerev is None:
+                    # tagged changeset didn't touch the file
+                    filerev = self.repo[node][repo_file].filerev()
+            except (IndexError, LookupError):
+                logger.warning("Tag %r points to a missing revision", name)
+                continue
+            self._index_tag(repo_file, tag.decode('utf-8', 'replace'), filerev)
+
+        return self._tags
+
+    def _index_tag(self, repo_file, tag, filerev):
+        """Add a document tag to the tag index, moving it if it already exists."""
+        tags = self._tags['tags'].setdefault(repo_file, {})
+        revisions = self._tags['revisions'].setdefault(repo_file, {})
+        if tag in tags:
+            revisions[tags[tag]].remove(tag)
+        tags[tag] = filerev
+        revisions.setdefault(filerev, []).append(tag)
 
     def _file_path(self, title, type='.xml'):
         """ Return plain version if exists in repo, add extension otherwise. """
         path = os.path.join(self.path, urlquote(title, safe=''))
-        if type and self._title_to_file(title, '') not in self.repo['tip']:
+        if type and self._title_to_file(title, '') not in self._tip_index()['files']:
             path += type
         return path
 
     def _title_to_file(self, title, type=".xml"):
         """ Return plain version if exists in repo, add extension otherwise. """
         path = os.path.join(self.repo_prefix, urlquote(title, safe=''))
-        if type and path not in self.repo['tip']:
+        if type and path not in self._tip_index()['files']:
             path += type
         return path
 
+    def _is_page_file(self, filename):
+        """Check if a repository file holds a page (and isn't e.g. '.hgtags')."""
+        return (filename.startswith(self.repo_prefix)
+                and not filename[len(self.repo_prefix):].lstrip('/').startswith('.'))
+
     def _file_to_title(self, filename):
         assert filename.startswith(self.repo_prefix)
         name = filename[len(self.repo_prefix):].strip('/').split('.', 1)[0]
         return urlunquote(name)
 
     def __contains__(self, title):
-        return self._title_to_file(title) in self.repo['tip']
+        return self._title_to_file(title) in self._tip_index()['files']
 
     def __iter__(self):
         return self.all_pages()
 
-    def merge_changes(self, changectx, repo_file, text, user, parent):
-        """Commits and merges conflicting changes in the repository."""
-        tip_node = changectx.node()
-        filectx = changectx[repo_file].filectx(parent)
-        parent_node = filectx.changectx().node()
-
-        self.repo.dirstate.setparents(parent_node)
-        node = self._commit([repo_file], text, user)
-
-        partial = lambda filename: repo_file == filename
-
-        # If p1 is equal to p2, there is no work to do. Even the dirstate is correct.
-        p1, p2 = self.repo[None].parents()[0], self.repo[tip_node]
-        if p1 == p2:
-            return text
+    def merge_changes(self, changectx, repo_file, data, user, comment, parent):
+        """
+        Commit data as a change to given revision of the file, and merge
+        it with the file's version at `changectx`. Returns the new commit's
+        node, the merged data and a description for the merge commit.
+        """
+        parent_fctx = changectx[repo_file].filectx(parent)
+        node = self._commit({repo_file: data}, comment, user,
+                            parents=(parent_fctx.changectx().node(), mercurial.node.nullid))
 
         try:
-            mercurial.merge.update(self.repo, tip_node, True, False, partial)
+            # as when merging in a working copy: the new data is local
+            merge = mercurial.simplemerge.Merge3Text(
+                parent_fctx.data(), data, changectx[repo_file].data())
+            data = ''.join(merge.merge_lines(name_a='local', name_b='other'))
             msg = 'merge of edit conflict'
         except mercurial.util.Abort:
             msg = 'failed merge of edit conflict'
+        return node, data, msg
 
-        self.repo.dirstate.setparents(tip_node, node)
-        # Mercurial 1.1 and later need updating the merge state
+    def save_file(self, title, file_name, **kwargs):
+        """Save an existing file as specified page, see `save_data`."""
+        f = open(file_name, "rb")
         try:
-            mercurial.merge.mergestate(self.repo).mark(repo_file, "r")
-        except (AttributeError, KeyError):
-            pass
-        return msg
+            data = f.read()
+        finally:
+            f.close()
+        result = self.save_data(title, data, **kwargs)
+        os.unlink(file_name)
+        return result
 
-    @with_working_copy_locked
     @with_storage_locked
-    def save_file(self, title, file_name, **kwargs):
-        """Save an existing file as specified page."""
-
+    def save_data(self, title, data, **kwargs):
+        """
+        Save data as specified page. If the page changed since its `parent`
+        revision, the data is merged with those changes. Returns the page's
+        new revision and whether it was merged.
+        """
         author = kwargs.get('author', u'anonymous').encode('utf-8')
         comment = kwargs.get('comment', u'Empty comment.').encode('utf-8')
         parent = kwargs.get('parent', None)
 
         repo_file = self._title_to_file(title)
-        file_path = self._file_path(title)
-        mercurial.util.rename(file_name, file_path)
         changectx = self._changectx()
 
         try:
-            filectx_tip = changectx[repo_file]
-            current_page_rev = filectx_tip.filerev()
+            current_page_rev = changectx[repo_file].filerev()
         except mercurial.revlog.LookupError:
-            self.repo[None].add([repo_file])
             current_page_rev = -1
 
-        if parent is not None and current_page_rev != parent:
-            msg = self.merge_changes(changectx, repo_file, comment, author, parent)
-            author = '<wiki>'
-            comment = msg.encode('utf-8')
-
-        logger.debug("Commiting %r", repo_file)
-
-        return self._commit([repo_file], comment, author)
-
-    def save_data(self, title, data, **kwargs):
-        """Save data as specified page."""
-        try:
-            temp_path = tempfile.mkdtemp(dir=self.path)
-            file_path = os.path.join(temp_path, 'saved')
-            f = open(file_path, "wb")
-            f.write(data)
-            f.close()
-
-            return self.save_file(title=title, file_name=file_path, **kwargs)
-        finally:
-            try:
-                os.unlink(file_path)
-            except OSError:
-                pass
-            try:
-                os.rmdir(temp_path)
-            except OSError:
-                pass
+        if parent is not None and current_page_rev not in (parent, -1):
+            logger.debug("Merging %r", repo_file)
+            node, data, msg = self.merge_changes(changectx, repo_file, data, author, comment, parent)
+            node = self._commit({repo_file: data}, msg, '<wiki>',
+                                parents=(changectx.node(), node))
+            merged = True
+        else:
+            logger.debug("Commiting %r", repo_file)
+            node = self._commit({repo_file: data}, comment, author)
+            merged = False
+        return self.repo[node][repo_file].filerev(), merged
 
     def save_text(self, **kwargs):
         """Save text as specified page, encoded to charset."""
         text = kwargs.pop('text')
         return self.save_data(data=text.encode(self.charset), **kwargs)
 
-    def _commit(self, files, comment, user):
-        match = mercurial.match.exact(self.repo_path, '', list(files))
-        return self.repo.commit(match=match, text=comment, user=user, force=True)
+    @with_storage_locked
+    def save_many(self, pages, author=u'anonymous', comment=u'Empty comment.', separate=False):
+        """
+        Save many pages at once: `pages` is an iterable of (title, text)
+        pairs. All of them are committed under a single lock, as one
+        changeset, or as one changeset per page if `separate` is set.
+        Returns the node of the last commit.
+        """
+        author = author.encode('utf-8')
+        comment = comment.encode('utf-8')
+        files = {}
+        node = None
+
+        for title, text in pages:
+            files[self._title_to_file(title)] = text.encode(self.charset)
+            if separate:
+                logger.debug("Commiting %r", files.keys())
+                node = self._commit(files, comment, author)
+                files = {}
+
+        if files:
+            logger.debug("Commiting %d files", len(files))
+            node = self._commit(files, comment, author)
+        return node
+
+    def _commit(self, files, comment, user, parents=None):
+        """
+        Commit new contents of files (None for removed files) on top of
+        given parent changesets, by default the tip. The changeset is built
+        in memory, without touching the working copy. Returns its node.
+        """
+        if parents is None:
+            parents = (self.repo.changelog.tip(), mercurial.node.nullid)
+
+        def filectxfn(repo, memctx, path):
+            data = files[path]
+            if data is None:
+                raise IOError(errno.ENOENT, "%s is removed" % path)
+            return mercurial.context.memfilectx(path, data)
+
+        ctx = mercurial.context.memctx(self.repo, parents, comment,
+                                       sorted(files), filectxfn, user)
+        node = self.repo.commitctx(ctx)
+        try:
+            self._update_history_index()
+        except (IOError, OSError):
+            logger.exception("Unable to update history index of %r", self.repo_path)
+        return node
 
-    @with_working_copy_locked
     @with_storage_locked
     def delete_page(self, title, author=u'', comment=u''):
         user = author.encode('utf-8') or 'anon'
         text = comment.encode('utf-8') or 'deleted'
         repo_file = self._title_to_file(title)
-        file_path = self._file_path(title)
-        try:
-            os.unlink(file_path)
-        except OSError:
-            pass
-        self.repo[None].remove([repo_file])
-        return self._commit([repo_file], text, user)
+        return self._commit({repo_file: None}, text, user)
 
     def page_text(self, title, revision=None):
         """Read unicode text of a page."""
@@ -283,28 +545,33 @@ class VersionedStorage(object):
 
         return ctx.data().decode(self.charset, 'replace'), ctx.filerev()
 
+    def page_revision(self, title):
+        """Return the number of page's last revision, without reading its text."""
+        return self._find_filectx(title).filerev()
+
     def page_text_by_tag(self, title, tag):
         """Read unicode text of a taged page."""
         fname = self._title_to_file(title)
-        tag = u"{fname}#{tag}".format(**locals()).encode('utf-8')
 
         try:
-            ctx = self.repo[tag][fname]
-            return ctx.data().decode(self.charset, 'replace'), ctx.filerev()
-        except IndexError:
+            filerev = self._tag_index()['tags'][fname][tag]
+        except KeyError:
             raise DocumentNotFound(fname)
 
-    @with_working_copy_locked
+        ctx = mercurial.context.filectx(self.repo, fname,
+                                        fileid=filerev, filelog=self._filelog(fname))
+        return ctx.data().decode(self.charset, 'replace'), ctx.filerev()
+
     def page_file_meta(self, title):
-        """Get page's inode number, size and last modification time."""
-        try:
-            (_st_mode, st_ino, _st_dev, _st_nlink, _st_uid, _st_gid, st_size,
-             _st_atime, st_mtime, _st_ctime) = os.stat(self._file_path(title))
-        except OSError:
+        """
+        Get page's file id, size and last modification time. They come
+        from the file's last revision: the id is its revision number.
+        """
+        if title not in self:
             return 0, 0, 0
-        return st_ino, st_size, st_mtime
+        fctx = self._find_filectx(title)
+        return fctx.filerev(), fctx.size(), fctx.date()[0]
 
-    @with_working_copy_locked
     def page_meta(self, title, revision=None):
         """Get page's revision, date, last editor and his edit comment."""
         fctx = self._find_filectx(title, revision)
@@ -320,7 +587,18 @@ class VersionedStorage(object):
         }
 
     def repo_revision(self):
-        return self.repo['tip'].rev()
+        return len(self.repo.changelog) - 1
+
+    def revision_node(self, rev):
+        """
+        Return the hex node of a repository revision, or None if there's
+        no such revision. Comparing it with a node remembered earlier
+        tells if the history was rewritten since.
+        """
+        changelog = self.repo.changelog
+        if not -1 <= rev < len(changelog):
+            return None
+        return mercurial.node.hex(changelog.node(rev))
 
     def _changectx(self):
         return self.repo['tip']
@@ -333,121 +611,199 @@ class VersionedStorage(object):
         return guess_mime(self._file_path(title))
 
     def _find_filectx(self, title, rev=None):
-        """Find the last revision in which the file existed."""
-        tip = self._changectx()  # start with tip
+        """
+        Find given revision of the page's file, or the last revision
+        in which the file existed.
 
-        def tree_search(tip, repo_file):
-            logging.info("Searching for %r", repo_file)
-            current = tip
-            visited = set()
+        Revisions are looked up directly in the file's revlog, so this
+        doesn't depend on the length of repository's history, even
+        for pages that were deleted long ago.
+        """
+        repo_files = [self._title_to_file(title)]
+        plain_file = self._title_to_file(title, type='')
+        if plain_file not in repo_files:
+            repo_files.append(plain_file)
 
-            stack = [current]
-            visited.add(current)
+        for repo_file in repo_files:
+            filelog = self._filelog(repo_file)
 
-            while repo_file not in current:
-                if not stack:
-                    raise LookupError
+            if rev is None:
+                fileid = len(filelog) - 1
+            else:
+                try:
+                    fileid = int(rev)
+                except ValueError:
+                    raise DocumentNotFound(title)
 
-                current = stack.pop()
-                for parent in current.parents():
-                    if parent not in visited:
-                        stack.append(parent)
-                        visited.add(parent)
+            if not 0 <= fileid < len(filelog):
+                logger.info("Revision %r of %r not found", rev, repo_file)
+                continue
 
-            fctx = current[repo_file]
-            if rev is not None:
-                fctx = fctx.filectx(rev)
-                fctx.filerev()
-            return fctx
+            return mercurial.context.filectx(self.repo, repo_file,
+                                             fileid=fileid, filelog=filelog)
 
-        try:
-            return tree_search(tip, self._title_to_file(title))
-        except (IndexError, LookupError):
-            logging.info("XML file not found, trying plain")
-            try:
-                return tree_search(tip, self._title_to_file(title, type=''))
-            except (IndexError, LookupError):
-                raise DocumentNotFound(title)
+        raise DocumentNotFound(title)
 
-    def page_history(self, title):
-        """Iterate over the page's history."""
+    def page_history(self, title, offset=0, limit=None):
+        """
+        Iterate over the page's history, newest revisions first.
 
+        Skips `offset` newest revisions and yields at most `limit` entries.
+        Entries are read directly from the file's revlog and the changelog,
+        so the cost depends only on the number of entries yielded.
+        """
         filectx_tip = self._find_filectx(title)
+        filelog = self._filelog(filectx_tip.path())
+        changelog = self.repo.changelog
+        revision_tags = self._tag_index()['revisions'].get(filectx_tip.path(), {})
 
-        maxrev = filectx_tip.filerev()
+        maxrev = filectx_tip.filerev() - max(offset, 0)
         minrev = 0
+        if limit is not None:
+            minrev = max(maxrev - limit + 1, minrev)
+
         for rev in range(maxrev, minrev - 1, -1):
-            filectx = filectx_tip.filectx(rev)
-            date = datetime.datetime.fromtimestamp(filectx.date()[0])
-            author = filectx.user().decode('utf-8', 'replace')
-            comment = filectx.description().decode("utf-8", 'replace')
-            tags = [t.rsplit('#', 1)[-1] for t in filectx.changectx().tags() if '#' in t]
+            node = changelog.node(filelog.linkrev(rev))
+            _manifest, user, date, _files, comment, _extra = changelog.read(node)
 
             yield {
                 "version": rev,
-                "date": date,
-                "author": author,
-                "description": comment,
-                "tag": tags,
+                "date": datetime.datetime.fromtimestamp(date[0]),
+                "author": user.decode('utf-8', 'replace'),
+                "description": comment.decode("utf-8", 'replace'),
+                "tag": list(revision_tags.get(rev, ())),
             }
 
-    @with_working_copy_locked
+    @with_storage_locked
     def add_page_tag(self, title, rev, tag, user, doctag=True):
         ctitle = self._title_to_file(title)
+        doc_tag = tag
 
         if doctag:
-            tag = u"{ctitle}#{tag}".format(**locals()).encode('utf-8')
+            tag = u"{ctitle}#{tag}".format(**locals())
+        if isinstance(tag, unicode):
+            tag = tag.encode('utf-8')
+        if isinstance(user, unicode):
+            user = user.encode('utf-8')
 
         message = u"Assigned tag {tag!r} to version {rev!r} of {ctitle!r}".format(**locals()).encode('utf-8')
 
         fctx = self._find_filectx(title, rev)
-        self.repo.tag(
-            names=tag, node=fctx.node(), local=False,
-            user=user, message=message, date=None,
-        )
+        tags = self._tag_index()
 
-    def history(self):
-        """Iterate over the history of entire wiki."""
+        try:
+            hgtags = self._changectx()['.hgtags'].data()
+        except mercurial.revlog.LookupError:
+            hgtags = ''
+        if hgtags and not hgtags.endswith('\n'):
+            hgtags += '\n'
+        hgtags += '%s %s\n' % (mercurial.node.hex(fctx.node()), tag)
+        self._commit({'.hgtags': hgtags}, message, user)
+
+        # Update the index in place, unless someone else tagged in the meantime.
+        if len(self._filelog('.hgtags')) == tags['version'] + 1:
+            tags['version'] += 1
+            if doctag:
+                self._index_tag(ctitle, doc_tag, fctx.filerev())
+        else:
+            self._tags = None
 
-        changectx = self._changectx()
-        maxrev = changectx.rev()
-        minrev = 0
-        for wiki_rev in range(maxrev, minrev - 1, -1):
-            change = self.repo.changectx(wiki_rev)
-            date = datetime.datetime.fromtimestamp(change.date()[0])
-            author = change.user().decode('utf-8', 'replace')
-            comment = change.description().decode("utf-8", 'replace')
-            for repo_file in change.files():
-                if repo_file.startswith(self.repo_prefix):
-                    title = self._file_to_title(repo_file)
-                    try:
-                        rev = change[repo_file].filerev()
-                    except mercurial.revlog.LookupError:
-                        rev = -1
-                    yield title, rev, date, author, comment
+    def history(self, cursor=None, limit=None, author=None, since=None, until=None, prefix=None):
+        """
+        Iterate over the history of entire wiki, newest first, as dicts
+        with changeset's revision, date, author, description and titles
+        of changed pages.
+
+        Only changesets before the `cursor` revision are listed, at most
+        `limit` of them. They can be filtered by `author` (a part of it),
+        date (`since` inclusive, `until` exclusive) and `prefix` of
+        changed pages' titles.
+        """
+        entries = self._history_index()
+        if cursor is None:
+            start = len(entries)
+        else:
+            start = max(0, min(int(cursor), len(entries)))
+        if author is not None:
+            author = author.lower()
+        if since is not None:
+            since = time.mktime(since.timetuple())
+        if until is not None:
+            until = time.mktime(until.timetuple())
+
+        count = 0
+        for rev in xrange(start - 1, -1, -1):
+            if limit is not None and count >= limit:
+                return
+            rev, node, timestamp, user, files = entries[rev]
+            if since is not None and timestamp < since:
+                continue
+            if until is not None and timestamp >= until:
+                continue
+            user = user.decode('utf-8', 'replace')
+            if author is not None and author not in user.lower():
+                continue
+
+            pages = [self._file_to_title(filename) for filename in files
+                        if self._is_page_file(filename)]
+            if prefix is not None:
+                pages = [title for title in pages if title.startswith(prefix)]
+                if not pages:
+                    continue
+
+            count += 1
+            yield {
+                "revision": rev,
+                "date": datetime.datetime.fromtimestamp(timestamp),
+                "author": user,
+                "description": self.repo.changelog.read(node)[4].decode('utf-8', 'replace'),
+                "pages": pages,
+            }
 
     def all_pages(self, type=''):
-        tip = self.repo['tip']
         """Iterate over the titles of all pages in the wiki."""
-        return [self._file_to_title(filename) for filename in tip
-                  if not filename.startswith('.')
-                    and filename.endswith(type) ]
-
-    def changed_since(self, rev):
-        """Return all pages that changed since specified repository revision."""
+        index = self._tip_index()
+        try:
+            pages = index['pages'][type]
+        except KeyError:
+            pages = index['pages'][type] = [
+                self._file_to_title(filename) for filename in sorted(index['files'])
+                    if not filename.startswith('.')
+                        and filename.endswith(type)]
+        return list(pages)
+
+    def changed_since(self, rev, limit=None):
+        """
+        Return pages that changed after given repository revision, and
+        the revision up to which the changes are included: pass it as
+        `rev` to get further changes. Only file lists of changesets
+        after `rev` are read.
+
+        With `limit`, the listing stops after the changeset in which
+        that many pages were found. For an unknown revision, pages are
+        listed from the first changeset on, including deleted ones.
+        """
+        changelog = self.repo.changelog
+        tip = len(changelog) - 1
 
         try:
-            last = self.repo.lookup(int(rev))
-        except IndexError:
-            for page in self.all_pages():
-                yield page
-                return
-        current = self.repo.lookup('tip')
-        status = self.repo.status(current, last)
-        modified, added, removed, deleted, unknown, ignored, clean = status
-        for filename in modified + added + removed + deleted:
-            if filename.startswith(self.repo_prefix):
-                yield self._file_to_title(filename)
+            rev = int(rev)
+        except (TypeError, ValueError):
+            rev = None
+        if rev is None or not -1 <= rev <= tip:
+            rev = -1
+
+        pages = []
+        seen = set()
+        while rev < tip and (limit is None or len(pages) < limit):
+            rev += 1
+            for filename in changelog.read(changelog.node(rev))[3]:
+                if self._is_page_file(filename):
+                    title = self._file_to_title(filename)
+                    if title not in seen:
+                        seen.add(title)
+                        pages.append(title)
+        return pages, rev
 
     def revert(self, pageid, rev, **commit_args):
         """ Make the given version of page the current version (reverting changes). """
@@ -456,7 +812,160 @@ class VersionedStorage(object):
         fctx = self._find_filectx(pageid, rev)
 
         # Restore the contents
-        new_node = self.save_data(pageid, fctx.data(), **commit_args)
+        data = fctx.data()
+        new_rev, merged = self.save_data(pageid, data, **commit_args)
+        return data, new_rev
+
+
+class CommitQueue(threading.Thread):
+    """
+    Thread making all changes to one repository, on behalf of other threads
+    of the process (see `queue_commit`). Changes waiting in the queue are
+    made together, under a single acquisition of the repository lock.
+    The thread exits after being idle for `idle_timeout` seconds.
+    """
+
+    idle_timeout = 60
+
+    def __init__(self, path, charset=None):
+        threading.Thread.__init__(self, name="vstorage commits: %s" % path)
+        self.setDaemon(True)
+        self.path = path
+        self.charset = charset
+        self.intents = Queue.Queue()
 
-        fctx = self.repo[new_node].filectx(fctx.path());
-        return fctx.data(), fctx.filerev()
+    def run(self):
+        try:
+            self._run()
+        except Exception:
+            logger.exception("Commit thread of %r failed", self.path)
+            self._fail(sys.exc_info())
+
+    def _fail(self, exc_info):
+        """Stop taking changes and report the error to everyone waiting."""
+        _commit_queues_lock.acquire()
+        try:
+            if _commit_queues.get(self.path) is self:
+                del _commit_queues[self.path]
+        finally:
+            _commit_queues_lock.release()
+
+        # nothing is queued here any more, once it's unregistered
+        try:
+            while True:
+                intent = self.intents.get_nowait()
+                if intent is not None:
+                    intent['error'] = exc_info
+                    intent['done'].set()
+        except Queue.Empty:
+            pass
+
+    def _run(self):
+        storage = VersionedStorage(self.path, self.charset)
+        while True:
+            try:
+                intents = [self.intents.get(timeout=self.idle_timeout)]
+            except Queue.Empty:
+                _commit_queues_lock.acquire()
+                try:
+                    if self.intents.empty():
+                        del _commit_queues[self.path]
+                        return
+                finally:
+                    _commit_queues_lock.release()
+                continue
+
+            try:
+                while True:
+                    intents.append(self.intents.get_nowait())
+            except Queue.Empty:
+                pass
+
+            stop = None in intents
+            intents = [intent for intent in intents if intent is not None]
+            if intents:
+                self._make(storage, intents)
+            if stop:
+                return
+
+    def _make(self, storage, intents):
+        logger.debug("Making %d changes in %r", len(intents), self.path)
+        try:
+            storage.refresh()
+            lock = storage.repo.lock()
+            try:
+                for intent in intents:
+                    try:
+                        intent['result'] = getattr(storage, intent['method'])(
+                                *intent['args'], **intent['kwargs'])
+                    except Exception:
+                        intent['error'] = sys.exc_info()
+            finally:
+                lock.release()
+        except Exception:
+            # locking failed, report it to everyone who got no result
+            exc_info = sys.exc_info()
+            for intent in intents:
+                if 'result' not in intent:
+                    intent['error'] = exc_info
+
+        # wake up the waiting threads only after the lock is released
+        for intent in intents:
+            intent['done'].set()
+
+
+_commit_queues = {}
+_commit_queues_lock = threading.Lock()
+
+# How often (in seconds) threads waiting for their changes check
+# if the commit thread is still alive.
+COMMIT_WAIT_INTERVAL = 5
+
+def _stop_commit_queues():
+    """Let commit threads finish before the interpreter exits."""
+    _commit_queues_lock.acquire()
+    try:
+        queues = _commit_queues.values()
+        for queue in queues:
+            queue.intents.put(None)
+        _commit_queues.clear()
+    finally:
+        _commit_queues_lock.release()
+    for queue in queues:
+        queue.join()
+
+atexit.register(_stop_commit_queues)
+
+def queue_commit(path, method, *args, **kwargs):
+    """
+    Call given method of the VersionedStorage at `path` in the repository's
+    commit thread, wait for it to finish and return its result.
+
+    The repository lock is only ever taken by the commit thread, so
+    concurrent saves don't time out waiting for them, and readers never
+    wait at all.
+    """
+    intent = {
+        'method': method,
+        'args': args,
+        'kwargs': kwargs,
+        'done': threading.Event(),
+    }
+
+    _commit_queues_lock.acquire()
+    try:
+        queue = _commit_queues.get(path)
+        if queue is None:
+            queue = _commit_queues[path] = CommitQueue(path)
+            queue.start()
+        queue.intents.put(intent)
+    finally:
+        _commit_queues_lock.release()
+
+    while not intent['done'].wait(COMMIT_WAIT_INTERVAL):
+        if not queue.isAlive() and not intent['done'].isSet():
+            raise RuntimeError("Commit thread of %r died" % path)
+    if 'error' in intent:
+        exc_type, exc_value, tb = intent['error']
+        raise exc_type, exc_value, tb
+    return intent['result']
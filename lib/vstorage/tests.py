@@ -6,10 +6,12 @@
 #
 
 import os
+import datetime
 import tempfile
 from nose.tools import *
 from nose.core import runmodule
 
+import mercurial.node
 import vstorage
 
 def clear_directory(top):
@@ -97,19 +99,22 @@ class TestVersionedStorage(object):
         assert_equal(saved_text, text)
         assert_equal(rev, 0)
 
-        self.repo.save_text(title=title,
+        result = self.repo.save_text(title=title,
                     text=text1, author=author,
                     comment=comment, parent=0)
+        assert_equal(result, (1, False))
 
         saved_text, rev = self.repo.page_text(title)
         assert_equal(saved_text, text1)
         assert_equal(rev, 1)
 
-        self.repo.save_text(title=title,
+        new_rev, merged = self.repo.save_text(title=title,
                     text=text2, author=author,
                     comment=comment, parent=0)
+        ok_(merged)
 
         saved_text, rev = self.repo.page_text(title)
+        assert_equal(rev, new_rev)
         # Other conflict markers placement can also be correct
         assert_equal(saved_text, u'''\
 text
@@ -135,6 +140,132 @@ text
 
         ok_(title not in self.repo, "Document in repository after delete")
 
+    def test_all_pages(self):
+        assert_equal(self.repo.all_pages(), [])
+        self.repo.save_text(title=u"one", text=u"1")
+        assert_equal(self.repo.all_pages(), [u"one"])
+        ok_(u"one" in self.repo)
+        ok_(u"two" not in self.repo)
+
+        # the index has to notice the new tip
+        self.repo.save_text(title=u"two", text=u"2")
+        assert_equal(self.repo.all_pages(), [u"one", u"two"])
+        assert_equal(self.repo.all_pages('.txt'), [])
+        ok_(u"two" in self.repo)
+
+    def test_page_text_revision(self):
+        for text in (u"1", u"2", u"3"):
+            self.repo.save_text(title=u"one", text=text)
+        self.repo.save_text(title=u"two", text=u"other")
+
+        assert_equal(self.repo.page_text(u"one", 0), (u"1", 0))
+        assert_equal(self.repo.page_text(u"one", 1), (u"2", 1))
+        assert_equal(self.repo.page_text(u"one"), (u"3", 2))
+        assert_equal(self.repo.page_meta(u"one")["revision"], 2)
+        assert_raises(vstorage.DocumentNotFound, self.repo.page_text, u"one", 3)
+
+    def test_save_many(self):
+        self.repo.save_text(title=u"first", text=u"old", author=u"test author",
+                    comment=u"test comment", parent=None)
+        revision = self.repo.repo_revision()
+
+        self.repo.save_many([(u"first", u"new"), (u"second", u"text")],
+                    author=u"test author", comment=u"bulk")
+        assert_equal(self.repo.repo_revision(), revision + 1)
+        assert_equal(self.repo.page_text(u"first"), (u"new", 1))
+        assert_equal(self.repo.page_text(u"second"), (u"text", 0))
+
+        self.repo.save_many([(u"third", u"a"), (u"fourth", u"b")],
+                    author=u"test author", comment=u"bulk", separate=True)
+        assert_equal(self.repo.repo_revision(), revision + 3)
+        assert_equal(sorted(self.repo.all_pages()), [u"first", u"fourth", u"second", u"third"])
+
+    def test_queue_commit(self):
+        import threading
+        def save(n):
+            vstorage.queue_commit(self.repo_path, 'save_text', title=u"page %d" % n,
+                    text=u"text %d" % n, author=u"test author", comment=u"test comment")
+        threads = [threading.Thread(target=save, args=(n,)) for n in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.repo.refresh()
+        assert_equal(self.repo.repo_revision(), 9)
+        assert_equal(self.repo.page_text(u"page 5"), (u"text 5", 0))
+
+    def test_queue_commit_failure(self):
+        original = vstorage.VersionedStorage.__init__
+        def broken(self, *args, **kwargs):
+            raise IOError("broken")
+        vstorage.VersionedStorage.__init__ = broken
+        try:
+            assert_raises(IOError, vstorage.queue_commit, self.repo_path, 'save_text',
+                    title=u"title", text=u"text", author=u"test author", comment=u"test comment")
+        finally:
+            vstorage.VersionedStorage.__init__ = original
+        ok_(self.repo_path not in vstorage._commit_queues)
+
+        # a new thread takes the next changes
+        vstorage.queue_commit(self.repo_path, 'save_text', title=u"title",
+                text=u"text", author=u"test author", comment=u"test comment")
+        self.repo.refresh()
+        assert_equal(self.repo.page_text(u"title"), (u"text", 0))
+
+    def test_bare(self):
+        self.repo.save_text(title=u"title", text=u"text", author=u"test author",
+                    comment=u"test comment", parent=None)
+        vstorage.mercurial.hg.clean(self.repo.repo, self.repo.repo.changelog.tip(), False)
+        ok_(os.path.exists(os.path.join(self.repo_path, u"title.xml")))
+
+        repo = vstorage.VersionedStorage(self.repo_path, bare=True)
+        ok_(not os.path.exists(os.path.join(self.repo_path, u"title.xml")))
+        repo.save_text(title=u"title", text=u"new text", author=u"test author",
+                    comment=u"test comment", parent=0)
+        assert_equal(repo.page_text(u"title"), (u"new text", 1))
+        assert_equal(repo.page_file_meta(u"title")[:2], (1, 8))
+        assert_equal(repo.page_file_meta(u"missing"), (0, 0, 0))
+
+    def test_changed_since(self):
+        for n, title in enumerate((u"a", u"b", u"a", u"c")):
+            self.repo.save_text(title=title, text=u"text %d" % n, author=u"test author",
+                        comment=u"test comment", parent=None)
+        self.repo.delete_page(u"b", u"test author", u"test comment")
+
+        assert_equal(self.repo.changed_since(0), ([u"b", u"a", u"c"], 4))
+        assert_equal(self.repo.changed_since(0, limit=2), ([u"b", u"a"], 2))
+        assert_equal(self.repo.changed_since(2, limit=2), ([u"c", u"b"], 4))
+        assert_equal(self.repo.changed_since(4), ([], 4))
+        assert_equal(self.repo.changed_since(10), ([u"a", u"b", u"c"], 4))
+        assert_equal(self.repo.changed_since(None, limit=2), ([u"a", u"b"], 1))
+
+    def test_revision_node(self):
+        assert_equal(self.repo.revision_node(-1), "0" * 40)
+        self.repo.save_text(title=u"a", text=u"text", author=u"test author",
+                    comment=u"test comment", parent=None)
+        assert_equal(self.repo.revision_node(0), mercurial.node.hex(self.repo.repo.changelog.tip()))
+        assert_equal(self.repo.revision_node(1), None)
+
+    def test_global_history(self):
+        for n, (title, author) in enumerate([(u"a", u"ann"), (u"b", u"bob"), (u"ab", u"ann")]):
+            self.repo.save_text(title=title, text=u"text", author=author,
+                        comment=u"change %d" % n, parent=None)
+
+        history = list(self.repo.history())
+        assert_equal([entry["pages"] for entry in history], [[u"ab"], [u"b"], [u"a"]])
+        assert_equal(history[0]["description"], u"change 2")
+        assert_equal([entry["revision"] for entry in self.repo.history(cursor=2, limit=1)], [1])
+        assert_equal([entry["revision"] for entry in self.repo.history(author=u"ANN")], [2, 0])
+        assert_equal([entry["revision"] for entry in self.repo.history(prefix=u"a")], [2, 0])
+        tomorrow = datetime.datetime.now() + datetime.timedelta(days=1)
+        assert_equal(list(self.repo.history(since=tomorrow)), [])
+
+        # the index is kept up to date by commits and read by other instances
+        other = vstorage.VersionedStorage(self.repo_path)
+        assert_equal(list(other.history()), history)
+        ok_(os.path.exists(self.repo.repo.join(self.repo.HISTORY_INDEX)))
+
     @raises(vstorage.DocumentNotFound)
     def test_document_not_found(self):
         self.repo.page_text(u'unknown entity')
@@ -145,6 +276,17 @@ text
         same_repo = vstorage.VersionedStorage(self.repo_path)
         assert_equal(same_repo.repo_revision(), current_repo_revision)
 
+    def test_refresh_sees_other_commits(self):
+        self.repo.save_text(title=u'Python!', text=u'ham and spam')
+        other = vstorage.VersionedStorage(self.repo_path)
+        assert_false(other.refresh())
+
+        self.repo.save_text(title=u'Python!', text=u'spam and eggs')
+        ok_(other.refresh(), "Changelog change not detected.")
+        assert_false(other.refresh())
+        assert_equal(other.repo_revision(), self.repo.repo_revision())
+        assert_equal(other.page_text(u'Python!'), (u'spam and eggs', 1))
+
     def test_history(self):
         COMMITS = [
             {"author": "bunny", "text":"1", "comment": "Oh yeah!"},
@@ -162,6 +304,20 @@ text
             assert_equal(entry["description"], COMMITS[n]["comment"])
             assert_equal(entry["tag"], [])
 
+    def test_history_window(self):
+        for n in range(5):
+            self.repo.save_text(title=u"Sample", text=unicode(n), comment=u"Change %d" % n)
+        self.repo.save_text(title=u"Other", text=u"other")
+
+        versions = [entry["version"] for entry in self.repo.page_history(u"Sample", 1, 2)]
+        assert_equal(versions, [3, 2])
+
+        entries = list(self.repo.page_history(u"Sample", 3))
+        assert_equal([entry["version"] for entry in entries], [1, 0])
+        assert_equal(entries[0]["description"], u"Change 1")
+
+        assert_equal(list(self.repo.page_history(u"Sample", 5)), [])
+
     def test_data_revert(self):
         COMMITS = [
             {u"title": u"one", "author": "bunny", "text":"1.1", "comment": "1"},
@@ -239,3 +395,19 @@ class TestVSTags(object):
         for entry in reversed(history):
             expected = [tag[1] for tag in tags if tag[0] == entry["version"]]
             assert_equal(set(entry["tag"]), set(expected))
+
+    def test_text_by_tag(self):
+        self.repo.add_page_tag(self.TITLE_1, 1, "production", "mike")
+        assert_equal(self.repo.page_text_by_tag(self.TITLE_1, "production"), (u"2", 1))
+
+        # moving the tag to another version
+        self.repo.add_page_tag(self.TITLE_1, 3, "production", "mike")
+        assert_equal(self.repo.page_text_by_tag(self.TITLE_1, "production"), (u"4", 3))
+        assert_raises(vstorage.DocumentNotFound, self.repo.page_text_by_tag,
+                self.TITLE_1, "finished")
+
+        # index built from scratch agrees
+        other = vstorage.VersionedStorage(self.repo_path)
+        assert_equal(other.page_text_by_tag(self.TITLE_1, "production"), (u"4", 3))
+        history = dict((entry["version"], entry["tag"]) for entry in other.page_history(self.TITLE_1))
+        assert_equal(history, {0: [], 1: [], 2: [], 3: ["production"]})
@@ -38,6 +38,15 @@
 
     }
 
+    // Najmniejsza wersja skanu nie węższa niż galeria, albo oryginał
+    function imageURL(image, galleryWidth){
+        for (var i = 0; i < image.versions.length; i++) {
+            if (image.versions[i].width >= galleryWidth)
+                return image.versions[i].url;
+        }
+        return image.url;
+    }
+
     /*
      * Perspective
      */
@@ -142,7 +151,8 @@
         $('#imagesCount').html("/"+this.doc.galleryImages.length);
         this.$numberInput.val(newPage);
 		this.config().page = newPage;
-        $('.gallery-image img', this.$element).attr('src', this.doc.galleryImages[newPage - 1]);
+        $('.gallery-image img', this.$element).attr('src',
+            imageURL(this.doc.galleryImages[newPage - 1], $('.gallery-image', this.$element).width()));
     };
 
     ScanGalleryPerspective.prototype.alterZoom = function(delta){
@@ -139,8 +139,8 @@
 	/*
 	 * Fetch history of this document.
 	 *
-	 * from - First revision to fetch (default = 0) upto - Last revision to
-	 * fetch (default = tip)
+	 * from - Number of newest revisions to skip (default = 0) limit - Maximum
+	 * number of revisions to fetch (default = all)
 	 *
 	 */
 	WikiDocument.prototype.fetchHistory = function(params) {
@@ -153,7 +153,7 @@
 			dataType: 'json',
 			data: {
 				"from": params['from'],
-				"upto": params['upto']
+				"limit": params['limit']
 			},
 			success: function(data) {
 				params['success'](self, data);
@@ -168,7 +168,9 @@
 		var self = this;
 		params = $.extend({
 			'from': self.revision,
-			'to': self.revision
+			'to': self.revision,
+			'hunk_from': 0,
+			'hunk_limit': ''
 		}, noops, params);
 		$.ajax({
 			method: "GET",
@@ -176,7 +178,9 @@
 			dataType: 'html',
 			data: {
 				"from": params['from'],
-				"to": params['to']
+				"to": params['to'],
+				"hunk_from": params['hunk_from'],
+				"hunk_limit": params['hunk_limit']
 			},
 			success: function(data) {
 				params['success'](self, data);
@@ -199,7 +203,7 @@
 			dataType: 'json',
 			// data: {},
 			success: function(data) {
-				self.galleryImages = data;
+				self.galleryImages = data.images;
 				params['success'](self, data);
 			},
 			error: function() {
@@ -267,7 +271,8 @@
 					self.triggerDocumentChanged();
 				};
 
-				params['success'](self, changed, ((changed && "Udało się zapisać :)") || "Twoja wersja i serwera jest identyczna"));
+				params['success'](self, changed, ((data.merged && "Udało się zapisać, razem ze zmianami innych osób :)")
+					|| (changed && "Udało się zapisać :)") || "Twoja wersja i serwera jest identyczna"));
 			},
 			error: function(xhr) {
                 if ($('#header').hasClass('saving')) {
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of FNP-Redakcja, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+"""
+Compare JSON encoding of a synthetic document history: the old way
+(datetimes and lazy strings handled by the encoder's fallback) against
+the way wiki.views.history encodes it now.
+
+Usage: bench-json.py [ENTRIES]
+"""
+import sys
+import os
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'apps'))
+
+from django.conf import settings
+settings.configure(WIKI_REPOSITORY_PATH='/tmp')
+
+from django.utils.functional import lazy
+from wiki import helpers
+from wiki.helpers import json, ExtendedEncoder, format_datetime
+
+lazy_unicode = lazy(lambda s: s, unicode)
+
+
+def make_history(size):
+    start = datetime(2010, 1, 1)
+    for n in xrange(size - 1, -1, -1):
+        yield {
+            "version": n,
+            "date": start + timedelta(minutes=n),
+            "author": u"Redaktor %d <redaktor%d@example.org>" % (n % 50, n % 50),
+            "description": n % 10 and u"Poprawki w rozdziale %d" % n or lazy_unicode(u"Zakończony etap"),
+            "tag": n % 100 and [] or [u"ready-to-publish"],
+        }
+
+
+def encode_old(history):
+    return json.dumps(history, cls=ExtendedEncoder)
+
+
+def encode_new(history):
+    for entry in history:
+        entry["date"] = format_datetime(entry["date"])
+        entry["description"] = unicode(entry["description"])
+    return helpers.dumps(history)
+
+
+def main(size=10000, repeat=5):
+    print "Encoding %d history entries, best of %d:" % (size, repeat)
+    assert encode_old(list(make_history(10))) == encode_new(list(make_history(10)))
+
+    for name, encode in (("old", encode_old), ("new", encode_new)):
+        timer = timeit.Timer(lambda: encode(history),
+                             lambda: globals().update(history=list(make_history(size))))
+        best = min(timer.repeat(repeat, 1))
+        print "  %s: %.1f ms" % (name, best * 1000)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])